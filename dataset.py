@@ -2,6 +2,8 @@ import os
 import ast
 import random
 import shutil
+from datetime import datetime
+from lxml import etree
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
@@ -11,7 +13,7 @@ from torch.utils.data import Dataset, Subset
 import warnings
 warnings.filterwarnings("ignore", message="The 'gameclock' column does not match the defined value range.*", category=UserWarning, module=r"floodlight\.core\.events")
 
-from floodlight.io.dfl import read_position_data_xml, read_event_data_xml, read_pitch_from_mat_info_xml
+from floodlight.io.dfl import read_position_data_xml, read_event_data_xml, read_pitch_from_mat_info_xml, read_teamsheets_from_mat_info_xml
 from utils.utils import calc_velocites, correct_nan_velocities_and_positions, to_single_playing_direction
 from utils.data_utils import (
     infer_starters_from_tracking,
@@ -19,7 +21,7 @@ from utils.data_utils import (
     get_valid_player_columns_in_order,
     compute_cumulative_distances
 )
-from utils.graph_utils import build_graph_sequence_from_condition
+from utils.graph_utils import build_graph_sequence_from_condition, build_dense_graph_from_condition
 
 
 # .xml files in DFL -> .csv with Metrica_sports format
@@ -96,6 +98,120 @@ def process_match(xy, possession, ballstatus):
 
     return home, away
 
+# Streaming DFL ingest: positions_raw.xml -> the same (home, away) DataFrames as process_match.
+# Frames are parsed one at a time and written straight into one preallocated float32 array per team
+# (both halves, ball columns included), so peak memory stays close to the size of the output.
+def _iter_frames(filepath_positions):
+    frame_set = None
+    for event, elem in etree.iterparse(filepath_positions, events=("start", "end"), tag=("FrameSet", "Frame")):
+        if elem.tag == "FrameSet":
+            if event == "start":
+                frame_set = elem  # attributes are already available
+            else:
+                # drop the parsed frame set and its already processed siblings
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        elif event == "end":
+            yield frame_set, elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del frame_set[0]
+
+
+# First pass: frame range of each half (from the ball frame sets) and framerate
+def _dfl_periods(filepath_positions):
+    periods, times, framerate = {}, {}, None
+    for frame_set, frame in _iter_frames(filepath_positions):
+        if frame_set.get("TeamId").lower() != "ball":
+            continue
+        segment = frame_set.get("GameSection")
+        n = int(frame.get("N"))
+        if segment not in periods:
+            periods[segment] = (n, n)
+            times[segment] = [frame.get("T")]
+        else:
+            periods[segment] = (periods[segment][0], n)
+            if len(times[segment]) == 1:
+                times[segment].append(frame.get("T"))
+                delta = datetime.fromisoformat(times[segment][1]) - datetime.fromisoformat(times[segment][0])
+                framerate = int(round(1 / delta.total_seconds()))
+    return periods, framerate
+
+
+def process_match_streaming(filepath_positions, filepath_mat_info):
+    teamsheets = read_teamsheets_from_mat_info_xml(filepath_mat_info)
+    slots = {}  # PersonId -> (team, player column index), same assignment as read_position_data_xml
+    for team in ["Home", "Away"]:
+        teamsheets[team].add_xIDs()
+        pID_to_jID = teamsheets[team].get_links("pID", "jID")
+        jID_to_xID = teamsheets[team].get_links("jID", "xID")
+        for pID, jID in pID_to_jID.items():
+            slots[pID] = (team, jID_to_xID[jID])
+    num_players = {team: max(teamsheets[team].get_links("jID", "xID").values()) + 1 for team in ["Home", "Away"]}
+
+    periods, framerate = _dfl_periods(filepath_positions)
+    n_first = periods["firstHalf"][1] - periods["firstHalf"][0] + 1
+    n_second = periods["secondHalf"][1] - periods["secondHalf"][0] + 1
+    n_frames = n_first + n_second
+    half_offset = {"firstHalf": 0, "secondHalf": n_first}
+
+    # [frames, player x/y ... , ball_x, ball_y]
+    xy = {team: np.full((n_frames, 2 * num_players[team] + 2), np.nan, dtype=np.float32) for team in ["Home", "Away"]}
+    active = np.full(n_frames, np.nan, dtype=np.float32)
+    poss = np.full(n_frames, np.nan, dtype=np.float32)
+
+    # Second pass: fill the arrays frame by frame
+    current, target = None, None
+    for frame_set, frame in _iter_frames(filepath_positions):
+        if frame_set is not current:
+            current = frame_set
+            segment = frame_set.get("GameSection")
+            if segment not in half_offset:
+                target = None
+            elif frame_set.get("TeamId").lower() == "ball":
+                target = "ball"
+            else:
+                target = slots.get(frame_set.get("PersonId"))
+            row_offset = half_offset.get(segment, 0) - periods.get(segment, (0,))[0]
+        if target is None:
+            continue
+        row = int(frame.get("N")) + row_offset
+        coords = (float(frame.get("X")), float(frame.get("Y")))
+        if target == "ball":
+            xy["Home"][row, -2:] = coords
+            xy["Away"][row, -2:] = coords
+            active[row] = float(frame.get("BallStatus"))
+            poss[row] = float(frame.get("BallPossession"))
+        else:
+            team, xID = target
+            xy[team][row, 2 * xID:2 * xID + 2] = coords
+
+    # Same time axis as process_match
+    time_first = np.arange(n_first) / framerate
+    time_offset = time_first[-1]
+    time = np.concatenate([time_first, np.arange(n_second) / framerate + time_offset])
+    match_time = time.copy()
+    match_time[n_first:] -= time_offset
+    period = np.repeat([1, 2], [n_first, n_second])
+
+    dfs = []
+    for team, offset in [("Home", 0), ("Away", num_players["Home"])]:
+        # to_single_playing_direction
+        xy[team][n_first:] *= -1
+        columns = [f"{team}_{i}_{ax}" for i in np.arange(1, num_players[team] + 1) + offset for ax in ["x", "y"]]
+        df = pd.DataFrame(xy[team], columns=columns + ["ball_x", "ball_y"], copy=False)
+        df.index.name = "Frame"
+        df.insert(0, "Period", period)
+        df.insert(1, "Time [s]", time)
+        df["match_time"] = match_time
+        df["active"] = active
+        df["possession"] = poss
+        dfs.append(df)
+    home, away = dfs
+    return home, away, teamsheets
+
+
 def make_ball_holder_series(event_objects, half, framerate, n_frames, offset=0):
     holder = [None] * (n_frames + offset)
     all_events = pd.concat(
@@ -147,7 +263,8 @@ def make_ball_holder_series(event_objects, half, framerate, n_frames, offset=0):
 
 
 # Save DFL .xml files as .csv format
-def organize_and_process(data_path, save_path):
+# streaming=True: parse the position XML with process_match_streaming instead of floodlight (lower peak memory)
+def organize_and_process(data_path, save_path, streaming=False):
     # Searching Folder
     files = [f for f in os.listdir(data_path) if f.endswith(".xml")]
     for f in files:
@@ -171,11 +288,17 @@ def organize_and_process(data_path, save_path):
         if not (pos and info and events):
             return
 
-        xy, poss, ball, teamsheets, _ = read_position_data_xml(
-            os.path.join(match_dir, pos),
-            os.path.join(match_dir, info)
-        )
-        home, away = process_match(xy, poss, ball)
+        if streaming:
+            home, away, teamsheets = process_match_streaming(
+                os.path.join(match_dir, pos),
+                os.path.join(match_dir, info)
+            )
+        else:
+            xy, poss, ball, teamsheets, _ = read_position_data_xml(
+                os.path.join(match_dir, pos),
+                os.path.join(match_dir, info)
+            )
+            home, away = process_match(xy, poss, ball)
 
         save_match_dir = os.path.join(save_path, match_id)
         os.makedirs(save_match_dir, exist_ok=True)
@@ -240,7 +363,7 @@ def organize_and_process(data_path, save_path):
 
 
 class CustomDataset(Dataset):
-    def __init__(self, data_root, segment_length=200, condition_length=100, framerate=25, stride=12, zscore_stats = None, use_graph=False):
+    def __init__(self, data_root, segment_length=200, condition_length=100, framerate=25, stride=12, zscore_stats = None, use_graph=False, graph_backend='sparse'):
         self.data_root = data_root
         self.segment_length = segment_length
         self.condition_length = condition_length
@@ -257,6 +380,8 @@ class CustomDataset(Dataset):
         self.graph_cache = {}
         self.max_graph_cache_size = 5000
         self.use_graph = use_graph
+        # 'sparse': HeteroData (GeoBatch collation), 'dense': DenseGraph (default_collate)
+        self.build_graph = build_dense_graph_from_condition if graph_backend == 'dense' else build_graph_sequence_from_condition
     
     # Preprocess raw match data and extract valid trajectory segments
     def load_all_matches(self, data_root):
@@ -685,6 +810,7 @@ class CustomDataset(Dataset):
             condition_rel_columns.extend([f"{base_name}_rel_x", f"{base_name}_rel_y"])
 
         sample = {
+            "sample_idx": idx,
             "match_id": match_id,
             "condition": condition_tensor,
             "other": other_tensor,
@@ -712,7 +838,7 @@ class CustomDataset(Dataset):
                     oldest_idx = next(iter(self.graph_cache))
                     del self.graph_cache[oldest_idx]
                     
-                self.graph_cache[idx] = build_graph_sequence_from_condition({
+                self.graph_cache[idx] = self.build_graph({
                     "condition": condition_tensor,
                     "condition_columns": sample["condition_columns"],
                     "pitch_scale": sample["pitch_scale"],
@@ -724,7 +850,7 @@ class CustomDataset(Dataset):
         return sample
     
 class ApplyAugmentedDataset(Dataset):
-    def __init__(self, base_dataset, flip_prob = 0.7, use_graph=False):
+    def __init__(self, base_dataset, flip_prob = 0.7, use_graph=False, graph_backend='sparse'):
         self.base = base_dataset
         if isinstance(base_dataset, Subset):
             self.zscore_stats = base_dataset.dataset.zscore_stats
@@ -735,6 +861,7 @@ class ApplyAugmentedDataset(Dataset):
         self.total = self.N + self.flip_N
         self.flip_indices = random.sample(range(self.N), self.flip_N)
         self.use_graph = use_graph
+        self.build_graph = build_dense_graph_from_condition if graph_backend == 'dense' else build_graph_sequence_from_condition
 
     def __len__(self):
         return self.total
@@ -795,6 +922,7 @@ class ApplyAugmentedDataset(Dataset):
 
 
         sample = {
+            "sample_idx": -1 - base_sample["sample_idx"],  # flipped copy: its own (negative) id
             "match_id": base_sample["match_id"],
             "condition": cond,
             "other": other,
@@ -816,7 +944,7 @@ class ApplyAugmentedDataset(Dataset):
         }
         
         if self.use_graph:
-            sample["graph"] = build_graph_sequence_from_condition({
+            sample["graph"] = self.build_graph({
                 "condition": sample["condition"],
                 "condition_columns": sample["condition_columns"],
                 "pitch_scale": sample["pitch_scale"],
@@ -0,0 +1,376 @@
+import os
+os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+import gc
+import copy
+import logging
+import torch
+from datetime import datetime
+from tqdm.auto import tqdm
+
+from torch.utils.data import DataLoader, Subset
+from models.Diffoot_modules import Diffoot_DenoisingNetwork
+from models.Diffoot import Diffoot
+from models.encoder import InteractionGraphEncoder
+from dataset import CustomDataset, ApplyAugmentedDataset
+from utils.utils import set_everything, worker_init_fn, generator
+from utils.metrics import denorm_players, rel_to_absolute, trajectory_metrics, best_of_n, MetricAggregator
+from utils.data_utils import split_dataset_indices, custom_collate_fn
+from utils.graph_utils import build_graph_sequence_from_condition
+from utils.embedding_store import EmbeddingStore, encoder_key
+
+# Distillation of a trained Diffoot (50-step DDIM teacher) into a few-step student.
+# 'progressive': each round halves the number of DDIM steps: 50 -> 25 -> 13 -> 7 -> 4
+#                (student steps = (teacher steps - 1) // 2 + 1).
+# 'consistency': consistency distillation on the teacher's DDIM grid, sampled in 1-2 evaluations.
+# The graph encoder is frozen and shared by teacher and student.
+
+# SEED Fix
+SEED = 42
+set_everything(SEED)
+
+# Save Log / Logger Setting
+model_save_path = './results/logs/'
+os.makedirs(model_save_path, exist_ok=True)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s %(message)s',
+    filename=os.path.join(model_save_path, 'distill.log'),
+    filemode='w'
+)
+logger = logging.getLogger()
+
+# 1. Hyperparameter Setting
+hyperparams = {
+    'teacher_checkpoint': './results/logs/best_model.pth', # checkpoint saved by main_for_Diffoot.py
+    'data_save_path': "match_data",
+    'train_batch_size': 16,
+    'val_batch_size': 16,
+    'test_batch_size': 16,
+    'num_workers': 8,
+    'epochs_per_round': 5,
+    'learning_rate': 5e-5,
+    'device': 'cuda:1' if torch.cuda.is_available() else 'cpu',
+    'graph_backend': 'sparse', # 'sparse' / 'dense', the encoder weights work with either
+
+    'distill_mode': 'progressive', # 'progressive' | 'consistency'
+    'teacher_ddim_step': 50,
+    'min_ddim_step': 4, # stop halving once the student would go below this
+
+    # consistency distillation
+    'consistency_epochs': 20,
+    'consistency_use_teacher': True, # False: consistency training without the teacher
+    'ema_decay': 0.999,
+    'consistency_ddim_step': 2, # network evaluations at sampling time (1 + refinements)
+
+    # evaluation of the final student
+    'num_samples': 20,
+}
+teacher_checkpoint = hyperparams['teacher_checkpoint']
+data_save_path = hyperparams['data_save_path']
+train_batch_size = hyperparams['train_batch_size']
+val_batch_size = hyperparams['val_batch_size']
+test_batch_size = hyperparams['test_batch_size']
+num_workers = hyperparams['num_workers']
+epochs_per_round = hyperparams['epochs_per_round']
+learning_rate = hyperparams['learning_rate']
+device = hyperparams['device']
+graph_backend = hyperparams['graph_backend']
+distill_mode = hyperparams['distill_mode']
+teacher_ddim_step = hyperparams['teacher_ddim_step']
+min_ddim_step = hyperparams['min_ddim_step']
+consistency_epochs = hyperparams['consistency_epochs']
+consistency_use_teacher = hyperparams['consistency_use_teacher']
+ema_decay = hyperparams['ema_decay']
+consistency_ddim_step = hyperparams['consistency_ddim_step']
+num_samples = hyperparams['num_samples']
+
+logger.info(f"Hyperparameters: {hyperparams}")
+
+# 2. Load Teacher
+checkpoint = torch.load(teacher_checkpoint, map_location='cpu')
+zscore_stats = checkpoint['zscore_stats']
+teacher_hyperparams = checkpoint['hyperparams']
+csdi_config = {k: teacher_hyperparams[k] for k in (
+    "num_steps", "channels", "diffusion_embedding_dim", "nheads", "layers", "side_dim",
+    "time_seq_len", "feature_seq_len", "compressed_dim"
+)}
+side_dim = csdi_config['side_dim']
+
+# 3. Data Loading
+print("---Data Loading---")
+dataset = CustomDataset(data_root=data_save_path, zscore_stats=zscore_stats, use_graph=True, graph_backend=graph_backend)
+train_idx, val_idx, test_idx = split_dataset_indices(dataset, val_ratio=1/6, test_ratio=1/6, random_seed=SEED)
+
+train_dataloader = DataLoader(
+    ApplyAugmentedDataset(Subset(dataset, train_idx), use_graph=True, graph_backend=graph_backend),
+    batch_size=train_batch_size,
+    shuffle=True,
+    num_workers=num_workers,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=1,
+    collate_fn=custom_collate_fn,
+    worker_init_fn=worker_init_fn,
+    generator=generator(SEED)
+)
+
+val_dataloader = DataLoader(
+    Subset(dataset, val_idx),
+    batch_size=val_batch_size,
+    shuffle=False,
+    num_workers=num_workers,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=1,
+    collate_fn=custom_collate_fn,
+    worker_init_fn=worker_init_fn,
+)
+
+test_dataloader = DataLoader(
+    Subset(dataset, test_idx),
+    batch_size=test_batch_size,
+    shuffle=False,
+    num_workers=num_workers,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=1,
+    collate_fn=custom_collate_fn,
+    worker_init_fn=worker_init_fn
+)
+
+print("---Data Load!---")
+print(f"Train: {len(train_dataloader.dataset)} | Val: {len(val_dataloader.dataset)} | Test: {len(test_dataloader.dataset)}")
+
+# 4. Model Define
+sample = dataset[0]
+graph = build_graph_sequence_from_condition({
+    "condition": sample["condition"],
+    "condition_columns": sample["condition_columns"],
+    "pitch_scale": sample["pitch_scale"],
+    "zscore_stats": zscore_stats
+})
+in_dim = graph['Node'].x.size(1)
+
+graph_encoder = InteractionGraphEncoder(in_dim=in_dim, hidden_dim=side_dim, out_dim=side_dim,
+                                        mode=teacher_hyperparams.get('encoder_mode', 'flat'),
+                                        temporal_stride=teacher_hyperparams.get('temporal_stride', 10)).to(device)
+graph_encoder.load_state_dict(checkpoint['graph_encoder'])
+graph_encoder.eval()
+for p in graph_encoder.parameters():
+    p.requires_grad_(False)
+
+teacher = Diffoot(Diffoot_DenoisingNetwork(csdi_config), num_steps=csdi_config['num_steps']).to(device)
+teacher.load_state_dict(checkpoint['diff_model'])
+teacher.eval()
+
+logger.info(f"Teacher: {teacher_checkpoint} ({teacher_ddim_step} DDIM steps)")
+
+
+# The encoder is frozen: H of every (train / val, flipped) sample is computed once for all epochs and rounds
+embedding_store = EmbeddingStore(encoder_key(graph_encoder))
+
+
+def get_cond_info(batch, T_target):
+    with torch.no_grad():
+        H = embedding_store.lookup(batch["sample_idx"], lambda: graph_encoder(batch["graph"].to(device)), device) # [B, 256]
+    return H.unsqueeze(-1).unsqueeze(-1).expand(-1, H.size(1), 11, T_target)
+
+
+# 5. Distillation
+timestamp = datetime.now().strftime('%m%d')
+teacher_steps = teacher_ddim_step
+student_path = None
+sampler = "ddim"
+
+if distill_mode == 'progressive':
+    while (teacher_steps - 1) // 2 + 1 >= min_ddim_step:
+        student_steps = (teacher_steps - 1) // 2 + 1
+        for p in teacher.parameters():
+            p.requires_grad_(False)
+
+        student = copy.deepcopy(teacher)
+        for p in student.parameters():
+            p.requires_grad_(True)
+        optimizer = torch.optim.AdamW(student.parameters(), lr=learning_rate)
+
+        for epoch in tqdm(range(1, epochs_per_round + 1), desc=f"Distilling {teacher_steps} -> {student_steps} steps", leave=True):
+            student.train()
+            train_loss = 0
+
+            for batch in tqdm(train_dataloader, desc="Batch Training...", leave=False):
+                _, T_target, _ = batch["target"].shape
+                target_rel = batch["target_relative"].to(device).view(-1, T_target, 11, 2)  # [B, T, 11, 2]
+                cond_info = get_cond_info(batch, T_target)
+
+                loss = student.distillation_loss(teacher, target_rel, cond_info=cond_info, ddim_steps=student_steps)
+
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+                train_loss += loss.item()
+
+                del target_rel, cond_info, loss
+
+            student.eval()
+            val_loss = 0
+            with torch.no_grad():
+                for batch in tqdm(val_dataloader, desc="Validation", leave=False):
+                    _, T_target, _ = batch["target"].shape
+                    target_rel = batch["target_relative"].to(device).view(-1, T_target, 11, 2)
+                    cond_info = get_cond_info(batch, T_target)
+
+                    val_loss += student.distillation_loss(teacher, target_rel, cond_info=cond_info, ddim_steps=student_steps).item()
+
+            avg_train_loss = train_loss / len(train_dataloader)
+            avg_val_loss = val_loss / len(val_dataloader)
+
+            logger.info(f"[{teacher_steps} -> {student_steps} steps][Epoch {epoch}/{epochs_per_round}] "
+                        f"Train Loss={avg_train_loss:.6f} | Val Loss={avg_val_loss:.6f}")
+            tqdm.write(f"[{teacher_steps} -> {student_steps} steps][Epoch {epoch}] Train: {avg_train_loss:.6f} | Val: {avg_val_loss:.6f}")
+
+        # Same format as main_for_Diffoot.py so the student loads with the same generate API
+        student_path = os.path.join(model_save_path, f'{timestamp}_distilled_{student_steps}_steps.pth')
+        torch.save({
+            'diff_model': student.state_dict(),
+            'graph_encoder': graph_encoder.state_dict(),
+            'zscore_stats': zscore_stats,
+            'hyperparams': {**teacher_hyperparams, 'ddim_step': student_steps, 'eta': 0.0},
+            'teacher_ddim_step': teacher_steps,
+        }, student_path)
+        logger.info(f"Saved {student_steps}-step student: {student_path}")
+
+        teacher = student
+        teacher.eval()
+        teacher_steps = student_steps
+
+        del optimizer
+        torch.cuda.empty_cache()
+        gc.collect()
+
+elif distill_mode == 'consistency':
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+
+    student = copy.deepcopy(teacher)
+    for p in student.parameters():
+        p.requires_grad_(True)
+    target_model = copy.deepcopy(student)
+    for p in target_model.parameters():
+        p.requires_grad_(False)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=learning_rate)
+    consistency_teacher = teacher if consistency_use_teacher else None
+
+    for epoch in tqdm(range(1, consistency_epochs + 1), desc="Consistency distillation", leave=True):
+        student.train()
+        train_loss = 0
+
+        for batch in tqdm(train_dataloader, desc="Batch Training...", leave=False):
+            _, T_target, _ = batch["target"].shape
+            target_rel = batch["target_relative"].to(device).view(-1, T_target, 11, 2)  # [B, T, 11, 2]
+            cond_info = get_cond_info(batch, T_target)
+
+            loss = student.consistency_loss(target_model, target_rel, cond_info=cond_info,
+                                            teacher=consistency_teacher, num_intervals=teacher_ddim_step - 1)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            target_model.ema_update(student, decay=ema_decay)
+
+            train_loss += loss.item()
+
+            del target_rel, cond_info, loss
+
+        target_model.eval()
+        val_loss = 0
+        with torch.no_grad():
+            for batch in tqdm(val_dataloader, desc="Validation", leave=False):
+                _, T_target, _ = batch["target"].shape
+                target_rel = batch["target_relative"].to(device).view(-1, T_target, 11, 2)
+                cond_info = get_cond_info(batch, T_target)
+
+                val_loss += target_model.consistency_loss(target_model, target_rel, cond_info=cond_info,
+                                                          teacher=consistency_teacher, num_intervals=teacher_ddim_step - 1).item()
+
+        avg_train_loss = train_loss / len(train_dataloader)
+        avg_val_loss = val_loss / len(val_dataloader)
+
+        logger.info(f"[Consistency][Epoch {epoch}/{consistency_epochs}] Train Loss={avg_train_loss:.6f} | Val Loss={avg_val_loss:.6f}")
+        tqdm.write(f"[Consistency][Epoch {epoch}] Train: {avg_train_loss:.6f} | Val: {avg_val_loss:.6f}")
+
+    # The EMA target network is the sampler
+    student_path = os.path.join(model_save_path, f'{timestamp}_consistency_{consistency_ddim_step}_steps.pth')
+    torch.save({
+        'diff_model': target_model.state_dict(),
+        'graph_encoder': graph_encoder.state_dict(),
+        'zscore_stats': zscore_stats,
+        'hyperparams': {**teacher_hyperparams, 'ddim_step': consistency_ddim_step, 'eta': 0.0, 'sampler': 'consistency'},
+        'teacher_ddim_step': teacher_ddim_step,
+    }, student_path)
+    logger.info(f"Saved consistency model: {student_path}")
+
+    teacher = target_model
+    teacher.eval()
+    teacher_steps = consistency_ddim_step
+    sampler = "consistency"
+
+    del optimizer, student
+    torch.cuda.empty_cache()
+    gc.collect()
+
+else:
+    raise ValueError(f"Unknown distill_mode: {distill_mode}")
+
+logger.info(f"Distillation complete. Final student: {student_path} ({teacher_steps} {sampler} steps)")
+print(f"Final student: {student_path} ({teacher_steps} {sampler} steps)")
+
+# 6. Evaluation of the final student (Best-of-N, same metrics as main_for_Diffoot.py)
+teacher.eval()
+
+avg_stats = MetricAggregator()
+min_stats = MetricAggregator()
+
+with torch.no_grad():
+    for batch in tqdm(test_dataloader, desc="Test Inference", leave=True):
+        cond = batch["condition"].to(device)
+        _, T_target, _ = batch["target"].shape
+        target_columns = batch["target_columns"][0]
+        condition_columns = batch["condition_columns"][0]
+
+        target_x_indices = [condition_columns.index(c) for c in target_columns[0::2]]
+        target_y_indices = [condition_columns.index(c) for c in target_columns[1::2]]
+
+        last_past_cond = cond[:, -1]
+        initial_pos = denorm_players(torch.stack([
+            last_past_cond[:, target_x_indices],
+            last_past_cond[:, target_y_indices]
+        ], dim=-1), zscore_stats)  # [B, 11, 2]
+
+        target_abs = batch["target"].to(device).view(-1, T_target, 11, 2)
+        target_abs_denorm = denorm_players(target_abs, zscore_stats)
+
+        cond_info = get_cond_info(batch, T_target)
+        preds = teacher.generate(shape=target_abs.shape, cond_info=cond_info, ddim_steps=teacher_steps,
+                                 eta=0.0, num_samples=num_samples, sampler=sampler)
+
+        pred_absolute = rel_to_absolute(preds, initial_pos, zscore_stats)  # [S, B, T, 11, 2]
+        metrics = trajectory_metrics(pred_absolute, target_abs_denorm)  # [S, B]
+
+        avg_stats.update({k: v.mean(0) for k, v in metrics.items()})
+        min_stats.update(best_of_n(metrics))
+
+avg = avg_stats.summary()
+mins = min_stats.summary()
+print(f"ADE: {avg['ade'][0]:.3f} ± {avg['ade'][1]:.3f} meters")
+print(f"FDE: {avg['fde'][0]:.3f} ± {avg['fde'][1]:.3f} meters")
+print(f"Fréchet: {avg['frechet'][0]:.3f} ± {avg['frechet'][1]:.3f} meters")
+print(f"DE: {avg['de'][0]:.3f}° ± {avg['de'][1]:.3f}°")
+
+print(f"Best-of-{num_samples} Sampling (min):")
+print(f"minADE{num_samples}: {mins['ade'][0]:.3f} ± {mins['ade'][1]:.3f} meters")
+print(f"minFDE{num_samples}: {mins['fde'][0]:.3f} ± {mins['fde'][1]:.3f} meters")
+print(f"minFréchet{num_samples}: {mins['frechet'][0]:.3f} ± {mins['frechet'][1]:.3f} meters")
+print(f"minDE{num_samples}: {mins['de'][0]:.3f}° ± {mins['de'][1]:.3f}°")
+logger.info(f"[{sampler}, {teacher_steps} steps] minADE{num_samples}={mins['ade'][0]:.3f} minFDE{num_samples}={mins['fde'][0]:.3f} "
+            f"minFréchet{num_samples}={mins['frechet'][0]:.3f} minDE{num_samples}={mins['de'][0]:.3f}")
@@ -0,0 +1,256 @@
+import os
+os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+import json
+import logging
+import torch
+import torch.multiprocessing as mp
+from collections import defaultdict
+from tqdm.auto import tqdm
+
+from torch.utils.data import DataLoader, Subset
+from models.Diffoot_modules import Diffoot_DenoisingNetwork
+from models.Diffoot import Diffoot
+from models.encoder import InteractionGraphEncoder
+from dataset import CustomDataset
+from utils.utils import set_everything, worker_init_fn, get_autocast
+from utils.metrics import denorm_players, rel_to_absolute, trajectory_metrics, best_of_n, MetricAggregator
+from utils.data_utils import split_dataset_indices, custom_collate_fn
+from utils.graph_utils import build_graph_sequence_from_condition
+from utils.embedding_store import EmbeddingStore, encoder_key
+
+# Best-of-N evaluation of a saved checkpoint (main_for_Diffoot.py / distill_for_Diffoot.py .pth) without training.
+# The test split is cut into fixed shards of `shard_size` samples. Each finished shard is written atomically
+# to output_dir/shard_XXXXX.pt, so a rerun skips completed shards and resumes where it stopped.
+# Pending shards are spread over `devices`, one process per device. Every shard is seeded by its id,
+# so its result does not depend on which process ran it.
+# Graph encoder outputs are cached in `embedding_store` per test sample and encoder weights, so sampler sweeps and
+# checkpoints sharing an encoder (e.g. distilled students) skip graph building and encoding.
+
+SEED = 42
+
+hyperparams = {
+    'checkpoint': './results/logs/best_model.pth',
+    'data_save_path': "match_data",
+    'output_dir': './results/eval',
+    'devices': [f'cuda:{i}' for i in range(torch.cuda.device_count())] or ['cpu'],
+    'shard_size': 256,
+    'test_batch_size': 16,
+    'num_workers': 4,
+    'num_samples': 20,
+    'amp_dtype': None,
+    'graph_backend': 'sparse', # 'sparse' / 'dense', the encoder weights work with either
+    'save_all_samples': False, # False: keep only the best-of-N (by ADE) prediction per sample
+    'embedding_store': './results/embeddings', # None: always run the graph encoder
+
+    # None: use the sampler settings stored in the checkpoint
+    'sampler': None,
+    'ddim_step': None,
+    'eta': None,
+}
+
+
+def shard_path(output_dir, shard_id):
+    return os.path.join(output_dir, f"shard_{shard_id:05d}.pt")
+
+
+# Sampler settings: eval hyperparams override the checkpoint's
+def sampler_settings(hp, ckpt_hp):
+    return {
+        'sampler': hp['sampler'] or ckpt_hp.get('sampler', 'ddim'),
+        'ddim_step': hp['ddim_step'] or ckpt_hp.get('ddim_step', 50),
+        'eta': hp['eta'] if hp['eta'] is not None else ckpt_hp.get('eta', 0.0),
+    }
+
+
+def load_models(checkpoint, dataset, device):
+    ckpt_hp = checkpoint['hyperparams']
+    csdi_config = {k: ckpt_hp[k] for k in (
+        "num_steps", "channels", "diffusion_embedding_dim", "nheads", "layers", "side_dim",
+        "time_seq_len", "feature_seq_len", "compressed_dim"
+    )}
+    side_dim = csdi_config['side_dim']
+
+    sample = dataset[0]
+    graph = build_graph_sequence_from_condition({
+        "condition": sample["condition"],
+        "condition_columns": sample["condition_columns"],
+        "pitch_scale": sample["pitch_scale"],
+        "zscore_stats": checkpoint['zscore_stats']
+    })
+    in_dim = graph['Node'].x.size(1)
+
+    graph_encoder = InteractionGraphEncoder(in_dim=in_dim, hidden_dim=side_dim, out_dim=side_dim,
+                                            mode=ckpt_hp.get('encoder_mode', 'flat'),
+                                            temporal_stride=ckpt_hp.get('temporal_stride', 10)).to(device)
+    graph_encoder.load_state_dict(checkpoint['graph_encoder'])
+    diff_model = Diffoot(Diffoot_DenoisingNetwork(csdi_config), num_steps=csdi_config['num_steps']).to(device)
+    diff_model.load_state_dict(checkpoint['diff_model'])
+    return diff_model.eval(), graph_encoder.eval()
+
+
+def run_shards(rank, shards_per_rank, hp):
+    device = hp['devices'][rank]
+    set_everything(SEED)
+
+    checkpoint = torch.load(hp['checkpoint'], map_location='cpu')
+    zscore_stats = checkpoint['zscore_stats']
+    settings = sampler_settings(hp, checkpoint['hyperparams'])
+
+    dataset = CustomDataset(data_root=hp['data_save_path'], zscore_stats=zscore_stats, use_graph=True, graph_backend=hp['graph_backend'])
+    diff_model, graph_encoder = load_models(checkpoint, dataset, device)
+    num_samples = hp['num_samples']
+
+    store = None
+    if hp['embedding_store'] is not None:
+        ckpt_hp = checkpoint['hyperparams']
+        key = encoder_key(graph_encoder, ckpt_hp.get('encoder_mode', 'flat'), ckpt_hp.get('temporal_stride', 10),
+                          zscore_stats, hp['amp_dtype'])
+        store = EmbeddingStore(key, root=hp['embedding_store'])
+
+    for shard_id, indices in tqdm(shards_per_rank[rank], desc=f"[{device}] Shards", position=rank):
+        path = shard_path(hp['output_dir'], shard_id)
+        if os.path.exists(path):
+            continue
+        torch.manual_seed(SEED + shard_id)
+        # graphs are only needed for samples without a stored embedding
+        dataset.use_graph = store is None or not store.contains_all(indices)
+
+        loader = DataLoader(
+            Subset(dataset, indices),
+            batch_size=hp['test_batch_size'],
+            shuffle=False,
+            num_workers=hp['num_workers'],
+            pin_memory=True,
+            collate_fn=custom_collate_fn,
+            worker_init_fn=worker_init_fn
+        )
+
+        records = defaultdict(list)
+        with torch.no_grad():
+            for batch in loader:
+                cond = batch["condition"].to(device)
+                B = cond.size(0)
+                _, T_target, _ = batch["target"].shape
+                target_columns = batch["target_columns"][0]
+                condition_columns = batch["condition_columns"][0]
+
+                target_x_indices = [condition_columns.index(c) for c in target_columns[0::2]]
+                target_y_indices = [condition_columns.index(c) for c in target_columns[1::2]]
+
+                last_past_cond = cond[:, -1]
+                initial_pos = denorm_players(torch.stack([
+                    last_past_cond[:, target_x_indices],
+                    last_past_cond[:, target_y_indices]
+                ], dim=-1), zscore_stats)  # [B, 11, 2]
+
+                target_abs = batch["target"].to(device).view(-1, T_target, 11, 2)
+                target_abs_denorm = denorm_players(target_abs, zscore_stats)
+
+                with get_autocast(device, hp['amp_dtype']):
+                    if store is None:
+                        H = graph_encoder(batch["graph"].to(device))
+                    else:
+                        H = store.lookup(batch["sample_idx"], lambda: graph_encoder(batch["graph"].to(device)), device)
+                    cond_info = H.unsqueeze(-1).unsqueeze(-1).expand(-1, H.size(1), 11, T_target)
+                    preds = diff_model.generate(shape=target_abs.shape, cond_info=cond_info, ddim_steps=settings['ddim_step'],
+                                                eta=settings['eta'], num_samples=num_samples, sampler=settings['sampler'])
+
+                pred_absolute = rel_to_absolute(preds, initial_pos, zscore_stats)  # [S, B, T, 11, 2]
+                metrics = trajectory_metrics(pred_absolute, target_abs_denorm)  # [S, B]
+                best_idx = metrics['ade'].argmin(0)
+
+                for k, v in metrics.items():
+                    records[k].append(v.t().cpu())  # [B, S]
+                records['best_idx'].append(best_idx.cpu())
+                records['pred_best'].append(pred_absolute[best_idx, torch.arange(B, device=device)].cpu())
+                if hp['save_all_samples']:
+                    records['preds'].append(pred_absolute.transpose(0, 1).half().cpu())  # [B, S, T, 11, 2]
+
+        if store is not None:
+            store.flush()
+        result = {k: torch.cat(v) for k, v in records.items()}
+        result['sample_idx'] = torch.tensor(indices)
+
+        # atomic write: a shard file exists only once it is complete
+        tmp_path = path + ".tmp"
+        torch.save(result, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def summarize(hp, num_shards):
+    avg_stats = MetricAggregator()
+    min_stats = MetricAggregator()
+    for shard_id in range(num_shards):
+        shard = torch.load(shard_path(hp['output_dir'], shard_id))
+        metrics = {k: shard[k].t() for k in ('ade', 'fde', 'frechet', 'de')}  # [S, n]
+        avg_stats.update({k: v.mean(0) for k, v in metrics.items()})
+        min_stats.update(best_of_n(metrics))
+    return {'avg': avg_stats.summary(), 'min': min_stats.summary()}
+
+
+if __name__ == "__main__":
+    set_everything(SEED)
+    output_dir = hyperparams['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s',
+        filename=os.path.join(output_dir, 'eval.log'),
+        filemode='a'
+    )
+    logger = logging.getLogger()
+    logger.info(f"Hyperparameters: {hyperparams}")
+
+    # Shards of a previous run are only reused for the same checkpoint / sampler / shard layout
+    checkpoint = torch.load(hyperparams['checkpoint'], map_location='cpu')
+    run_config = {
+        'checkpoint': os.path.abspath(hyperparams['checkpoint']),
+        'shard_size': hyperparams['shard_size'],
+        'num_samples': hyperparams['num_samples'],
+        **sampler_settings(hyperparams, checkpoint['hyperparams']),
+    }
+    del checkpoint
+    config_path = os.path.join(output_dir, 'config.json')
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            if json.load(f) != run_config:
+                raise ValueError(f"{output_dir} holds shards of a different evaluation run, use another output_dir")
+    else:
+        with open(config_path, 'w') as f:
+            json.dump(run_config, f, indent=2)
+
+    dataset = CustomDataset(data_root=hyperparams['data_save_path'])
+    _, _, test_idx = split_dataset_indices(dataset, val_ratio=1/6, test_ratio=1/6, random_seed=SEED)
+    del dataset
+
+    shard_size = hyperparams['shard_size']
+    shards = [(k, test_idx[i:i + shard_size]) for k, i in enumerate(range(0, len(test_idx), shard_size))]
+    pending = [s for s in shards if not os.path.exists(shard_path(output_dir, s[0]))]
+    print(f"Test: {len(test_idx)} samples | {len(shards)} shards | {len(pending)} pending")
+    logger.info(f"{len(shards)} shards, {len(pending)} pending")
+
+    if pending:
+        num_procs = min(len(hyperparams['devices']), len(pending))
+        shards_per_rank = [pending[r::num_procs] for r in range(num_procs)]
+        if num_procs == 1:
+            run_shards(0, shards_per_rank, hyperparams)
+        else:
+            mp.spawn(run_shards, args=(shards_per_rank, hyperparams), nprocs=num_procs)
+
+    summary = summarize(hyperparams, len(shards))
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump({**run_config, **summary}, f, indent=2)
+
+    num_samples = hyperparams['num_samples']
+    avg, mins = summary['avg'], summary['min']
+    print(f"ADE: {avg['ade'][0]:.3f} ± {avg['ade'][1]:.3f} meters")
+    print(f"FDE: {avg['fde'][0]:.3f} ± {avg['fde'][1]:.3f} meters")
+    print(f"Fréchet: {avg['frechet'][0]:.3f} ± {avg['frechet'][1]:.3f} meters")
+    print(f"DE: {avg['de'][0]:.3f}° ± {avg['de'][1]:.3f}°")
+
+    print(f"Best-of-{num_samples} Sampling (min):")
+    print(f"minADE{num_samples}: {mins['ade'][0]:.3f} ± {mins['ade'][1]:.3f} meters")
+    print(f"minFDE{num_samples}: {mins['fde'][0]:.3f} ± {mins['fde'][1]:.3f} meters")
+    print(f"minFréchet{num_samples}: {mins['frechet'][0]:.3f} ± {mins['frechet'][1]:.3f} meters")
+    print(f"minDE{num_samples}: {mins['de'][0]:.3f}° ± {mins['de'][1]:.3f}°")
+    logger.info(f"Summary: {summary}")
@@ -8,6 +8,7 @@ class Diffoot(nn.Module):
         super().__init__()
         self.model = model
         self.num_steps = num_steps
+        self._cuda_graphs = {}
 
         steps = num_steps + 1
         x = torch.linspace(0, num_steps, steps, dtype=torch.float64)
@@ -32,7 +33,7 @@ class Diffoot(nn.Module):
         x_t = torch.sqrt(a_hat) * x_0 + torch.sqrt(1 - a_hat) * noise
         return x_t, noise
 
-    def forward(self, target_abs, reference_point, zscore_stats, t=None, cond_info=None):
+    def forward(self, target_abs, reference_point=None, zscore_stats=None, t=None, cond_info=None, noise=None):
         B = target_abs.size(0)
         T = target_abs.size(1)
         device = target_abs.device
@@ -40,6 +41,11 @@ class Diffoot(nn.Module):
         if t is None:
             t = torch.randint(0, self.num_steps, (B,), device=device)
 
+        # target is already relative & normalized (batch["target_relative"])
+        if reference_point is None:
+            x_0 = target_abs.reshape(B, T, -1, 2)
+            return self.v_losses(x_0, t, cond_info, noise)
+
         N = reference_point.size(1) // 2
         target_abs_4d = target_abs.view(B, T, N, 2)
         ref_raw = reference_point.view(B, N, 2)
@@ -64,7 +70,11 @@ class Diffoot(nn.Module):
         else:
             x_0 = target_abs_4d - ref_raw.unsqueeze(1)
 
-        x_t, noise = self.q_sample(x_0, t)
+        return self.v_losses(x_0, t, cond_info, noise)
+
+    # noise: [B, T, N, 2] (None: drawn here)
+    def v_losses(self, x_0, t, cond_info=None, noise=None):
+        x_t, noise = self.q_sample(x_0, t, noise)
         x_t_in = x_t.permute(0, 3, 2, 1)
 
         a_hat = self.alpha_hat[t].view(-1, 1, 1, 1)
@@ -73,38 +83,138 @@ class Diffoot(nn.Module):
         v_target = sqrt_a * noise - sqrt_o * x_0
         
         z = self.model(x_t_in, t, cond_info)
-        z = z.permute(0, 3, 2, 1)
+        z = z.permute(0, 3, 2, 1).float()
 
-        v_pred, log_var = z[..., :2], z[..., 2:]
-        log_var = log_var.clamp(-10, 2)
-        var = log_var.exp()
+        # losses in fp32 even under autocast
+        with torch.autocast(device_type=z.device.type, enabled=False):
+            v_pred, log_var = z[..., :2], z[..., 2:]
+            log_var = log_var.clamp(-10, 2)
+            var = log_var.exp()
 
-        v_loss = F.mse_loss(v_pred, v_target)
-        
-        # NLL loss computing
-        nll = 0.5 * ((v_target - v_pred) ** 2 / var + log_var + math.log(2 * math.pi))
-        noise_nll = nll.mean()
+            v_loss = F.mse_loss(v_pred, v_target)
+
+            # NLL loss computing
+            nll = 0.5 * ((v_target - v_pred) ** 2 / var + log_var + math.log(2 * math.pi))
+            noise_nll = nll.mean()
 
         return v_loss, noise_nll
     
-    # DDIM Sampling
+    # DDIM timesteps (ascending). Integer spacing so that the grid of n steps
+    # is exactly every other point of the grid of 2n - 1 steps.
+    def ddim_timesteps(self, ddim_steps, device=None):
+        return torch.arange(ddim_steps, device=device) * (self.num_steps - 1) // max(ddim_steps - 1, 1)
+
+    def predict_v(self, x, t, cond_info=None):
+        x_in = x.permute(0, 3, 2, 1)
+        z = self.model(x_in, t, cond_info).permute(0, 3, 2, 1)
+        return z[..., :2].float()
+
+    # Deterministic (eta=0) DDIM step with per-sample t / t_prev, t_prev == 0 returns x0_pred
+    def ddim_step(self, x, v_pred, t, t_prev):
+        ah_t = self.alpha_hat[t].view(-1, 1, 1, 1)
+        ah_t_prev = self.alpha_hat[t_prev].view(-1, 1, 1, 1)
+        sqrt_ah_t = torch.sqrt(ah_t)
+        sqrt_o_t = torch.sqrt(1 - ah_t)
+
+        x0_pred = sqrt_ah_t * x - sqrt_o_t * v_pred
+        eps_pred = (x - sqrt_ah_t * x0_pred) / sqrt_o_t
+        x_prev = torch.sqrt(ah_t_prev) * x0_pred + torch.sqrt(1 - ah_t_prev) * eps_pred
+        return torch.where((t_prev > 0).view(-1, 1, 1, 1), x_prev, x0_pred)
+
+    # Progressive distillation (Salimans & Ho, 2022): one student step t -> t_prev
+    # matches two teacher DDIM steps t -> t_mid -> t_prev on the grid of 2 * ddim_steps - 1 steps.
+    def distillation_loss(self, teacher, x_0, cond_info=None, ddim_steps=25):
+        B = x_0.size(0)
+        device = x_0.device
+
+        teacher_timesteps = self.ddim_timesteps(2 * ddim_steps - 1, device=device)
+        k = torch.randint(1, ddim_steps, (B,), device=device)
+        t = teacher_timesteps[2 * k]
+        t_mid = teacher_timesteps[2 * k - 1]
+        t_prev = teacher_timesteps[2 * k - 2]
+
+        x_t, _ = self.q_sample(x_0, t)
+
+        with torch.no_grad():
+            x_mid = teacher.ddim_step(x_t, teacher.predict_v(x_t, t, cond_info), t, t_mid)
+            x_target = teacher.ddim_step(x_mid, teacher.predict_v(x_mid, t_mid, cond_info), t_mid, t_prev)
+
+            alpha_t = torch.sqrt(self.alpha_hat[t]).view(-1, 1, 1, 1)
+            sigma_t = torch.sqrt(1 - self.alpha_hat[t]).view(-1, 1, 1, 1)
+            alpha_prev = torch.sqrt(self.alpha_hat[t_prev]).view(-1, 1, 1, 1)
+            sigma_prev = torch.sqrt(1 - self.alpha_hat[t_prev]).view(-1, 1, 1, 1)
+
+            # x0 that makes a single student DDIM step land on the teacher's x_target
+            ratio = sigma_prev / sigma_t
+            x0_tilde = (x_target - ratio * x_t) / (alpha_prev - ratio * alpha_t)
+            x0_tilde = torch.where((t_prev > 0).view(-1, 1, 1, 1), x0_tilde, x_target)
+
+            eps_tilde = (x_t - alpha_t * x0_tilde) / sigma_t
+            v_target = alpha_t * eps_tilde - sigma_t * x0_tilde
+
+        v_pred = self.predict_v(x_t, t, cond_info)
+        return F.mse_loss(v_pred, v_target)
+
+    # Consistency function f(x_t, t) = x0_pred, boundary f(x, 0) ~= x since alpha_hat[0] ~= 1
+    def predict_x0(self, x, t, cond_info=None):
+        v_pred = self.predict_v(x, t, cond_info)
+        a_hat = self.alpha_hat[t].view(-1, 1, 1, 1)
+        return torch.sqrt(a_hat) * x - torch.sqrt(1 - a_hat) * v_pred
+
+    # Consistency distillation (Song et al., 2023) on the grid of `num_intervals + 1` DDIM steps.
+    # With teacher=None the adjacent point is taken from the same noise (consistency training).
+    def consistency_loss(self, target_model, x_0, cond_info=None, teacher=None, num_intervals=49):
+        B = x_0.size(0)
+        device = x_0.device
+
+        timesteps = self.ddim_timesteps(num_intervals + 1, device=device)
+        k = torch.randint(1, num_intervals + 1, (B,), device=device)
+        t = timesteps[k]
+        t_prev = timesteps[k - 1]
+
+        noise = torch.randn_like(x_0)
+        x_t, _ = self.q_sample(x_0, t, noise)
+
+        with torch.no_grad():
+            if teacher is not None:
+                x_prev = teacher.ddim_step(x_t, teacher.predict_v(x_t, t, cond_info), t, t_prev)
+            else:
+                x_prev, _ = self.q_sample(x_0, t_prev, noise)
+            target = target_model.predict_x0(x_prev, t_prev, cond_info)
+            target = torch.where((t_prev > 0).view(-1, 1, 1, 1), target, x_prev)
+
+        x0_pred = self.predict_x0(x_t, t, cond_info)
+        return F.mse_loss(x0_pred, target)
+
+    # EMA update of the consistency target network
     @torch.no_grad()
-    def generate(self, shape, reference_point, cond_info=None, ddim_steps=50, eta=0.0, num_samples=1):
-        B, T, N, D = shape
-        device = next(self.parameters()).device
+    def ema_update(self, source, decay=0.999):
+        for p, p_src in zip(self.parameters(), source.parameters()):
+            p.lerp_(p_src, 1 - decay)
+        for b, b_src in zip(self.buffers(), source.buffers()):
+            b.copy_(b_src)
 
-        timesteps = torch.linspace(0, self.num_steps - 1, ddim_steps, device=device).long()
-        alpha_hat = self.alpha_hat
+    # Consistency sampling: one evaluation from pure noise, then (ddim_steps - 1) re-noise / denoise refinements
+    @torch.no_grad()
+    def consistency_sample(self, x, cond_info=None, ddim_steps=1):
+        timesteps = self.ddim_timesteps(ddim_steps + 1, device=x.device)
+        t_batch = torch.full((x.size(0),), self.num_steps - 1, device=x.device, dtype=torch.long)
+        x0 = self.predict_x0(x, t_batch, cond_info)
 
-        if cond_info is not None:
-            cond_info = cond_info.to(device).unsqueeze(0).repeat(num_samples, 1, 1, 1, 1)
-            cond_info = cond_info.view(num_samples * B, *cond_info.shape[2:])
+        for t in reversed(timesteps[1:-1]):
+            t_batch = torch.full((x.size(0),), t, device=x.device, dtype=torch.long)
+            x_t, _ = self.q_sample(x0, t_batch)
+            x0 = self.predict_x0(x_t, t_batch, cond_info)
+        return x0
 
-        ref_raw = reference_point.view(B, N, D)
-        ref_raw = ref_raw.unsqueeze(0).repeat(num_samples, 1, 1, 1)
-        ref_raw = ref_raw.view(num_samples * B, N, D)
+    # Opt-in torch.compile of the denoiser (fixed K, L and channels); state_dict keys are unchanged
+    def compile_denoiser(self, mode=None):
+        self.model.compile(mode=mode, dynamic=False)
+        return self
 
-        x = torch.randn(num_samples * B, T, N, D, device=device)
+    def _ddim_loop(self, x, cond_info, timesteps, eta=0.0):
+        alpha_hat = self.alpha_hat
+        ddim_steps = len(timesteps)
 
         for i, t in enumerate(reversed(timesteps)):
             t_prev = 0 if i == ddim_steps - 1 else timesteps[-(i + 2)]
@@ -112,12 +222,12 @@ class Diffoot(nn.Module):
             ah_t = alpha_hat[t]
             ah_t_prev = alpha_hat[t_prev]
             
-            t_batch = torch.full((num_samples * B,), t, device=device, dtype=torch.long)
+            t_batch = torch.full((x.size(0),), t, device=x.device, dtype=torch.long)
             
             x_in = x.permute(0, 3, 2, 1)
         
             z = self.model(x_in, t_batch, cond_info).permute(0, 3, 2, 1)
-            v_pred = z[..., :2]
+            v_pred = z[..., :2].float()
             
             sqrt_ah_t = torch.sqrt(ah_t)
             sqrt_o_t = torch.sqrt(1 - ah_t)
@@ -134,11 +244,64 @@ class Diffoot(nn.Module):
 
                 c1 = torch.sqrt(ah_t_prev)
                 c2 = torch.sqrt(1 - ah_t_prev - sigma_t**2)
-                x_new = x.clone()
-                x_new = c1 * x0_pred + c2 * eps_pred + sigma_t * noise
-                x = x_new
+                x = c1 * x0_pred + c2 * eps_pred + sigma_t * noise
             else:
                 x = x0_pred
+        return x
+
+    # Whole DDIM loop captured once per (shape, schedule) and replayed from static buffers
+    def _graphed_ddim_loop(self, x, cond_info, timesteps, eta=0.0):
+        key = (x.device, tuple(x.shape), None if cond_info is None else tuple(cond_info.shape),
+               tuple(timesteps), eta, torch.is_autocast_enabled("cuda"))
+
+        if key not in self._cuda_graphs:
+            static_x = x.clone()
+            static_cond = None if cond_info is None else cond_info.clone()
+            # autocast weight cache must not outlive the capture
+            amp = torch.autocast("cuda", dtype=torch.get_autocast_dtype("cuda"),
+                                 enabled=torch.is_autocast_enabled("cuda"), cache_enabled=False)
+
+            stream = torch.cuda.Stream(device=x.device)
+            stream.wait_stream(torch.cuda.current_stream(x.device))
+            with torch.cuda.stream(stream), amp:
+                self._ddim_loop(static_x, static_cond, timesteps, eta)  # warm-up
+            torch.cuda.current_stream(x.device).wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph), amp:
+                static_out = self._ddim_loop(static_x, static_cond, timesteps, eta)
+            self._cuda_graphs[key] = (graph, static_x, static_cond, static_out)
+
+        graph, static_x, static_cond, static_out = self._cuda_graphs[key]
+        static_x.copy_(x)
+        if static_cond is not None:
+            static_cond.copy_(cond_info)
+        graph.replay()
+        return static_out.clone()
+
+    # DDIM Sampling
+    @torch.no_grad()
+    def generate(self, shape, reference_point=None, cond_info=None, ddim_steps=50, eta=0.0, num_samples=1, sampler="ddim",
+                 cuda_graph=False):
+        B, T, N, D = shape
+        device = next(self.parameters()).device
+
+        if cond_info is not None:
+            cond_info = cond_info.to(device).unsqueeze(0).repeat(num_samples, 1, 1, 1, 1)
+            cond_info = cond_info.view(num_samples * B, *cond_info.shape[2:])
+
+        x = torch.randn(num_samples * B, T, N, D, device=device)
+
+        if sampler == "consistency":
+            return self.consistency_sample(x, cond_info, ddim_steps=ddim_steps).view(num_samples, B, T, N, D)
+
+        # python ints: no host sync per step, and the schedule is fixed at capture time
+        timesteps = self.ddim_timesteps(ddim_steps).tolist()
+
+        if cuda_graph and device.type == "cuda":
+            x = self._graphed_ddim_loop(x, cond_info, timesteps, eta)
+        else:
+            x = self._ddim_loop(x, cond_info, timesteps, eta)
 
         rel_norm = x.view(num_samples, B, T, N, D)
-        return rel_norm
\ No newline at end of file
+        return rel_norm
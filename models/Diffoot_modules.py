@@ -2,6 +2,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 # def get_torch_trans(heads=4, layers=1, channels=128):
 #     encoder_layer = nn.TransformerEncoderLayer(
@@ -35,9 +36,9 @@ class LinearAttentionHead(nn.Module):
         if self.causal:
             seq_len, comp_dim = P_bar.size(1), P_bar.size(2)
             causal_mask = torch.triu(torch.ones(seq_len, comp_dim, device=P_bar.device)) == 1
-            P_bar = P_bar.masked_fill(~causal_mask, -1e10)
+            P_bar = P_bar.masked_fill(~causal_mask, torch.finfo(P_bar.dtype).min)
         
-        P_bar = P_bar.softmax(dim=-1)
+        P_bar = P_bar.softmax(dim=-1, dtype=torch.float32).to(Q.dtype)
         P_bar = self.dropout(P_bar)
 
         V = V.transpose(1, 2)
@@ -87,19 +88,21 @@ class LinformerMultiHead(nn.Module):
         out = torch.cat(head_outputs, dim=-1)
         return self.w_o(out)
 
-def get_linformer_trans(heads=4, layers=1, channels=128, seq_len=100, compressed_dim=32, causal=False):
+def get_linformer_trans(heads=4, layers=1, channels=128, seq_len=100, compressed_dim=32, causal=False, use_checkpoint=False):
     return LinformerTransformer(
         channels=channels,
         nheads=heads,
         seq_len=seq_len,
         compressed_dim=compressed_dim,
         causal=causal,
-        dropout=0.2
+        dropout=0.2,
+        use_checkpoint=use_checkpoint
     )
 
 class LinformerTransformer(nn.Module):
-    def __init__(self, channels, nheads, seq_len, compressed_dim=32, causal=False, dropout=0.2):
+    def __init__(self, channels, nheads, seq_len, compressed_dim=32, causal=False, dropout=0.2, use_checkpoint=False):
         super().__init__()
+        self.use_checkpoint = use_checkpoint
         self.attention = LinformerMultiHead(
             channels=channels,
             nheads=nheads, 
@@ -121,6 +124,12 @@ class LinformerTransformer(nn.Module):
         self.dropout = nn.Dropout(dropout)
         
     def forward(self, x):
+        # Activation checkpointing (recompute in backward) only when training
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(self._forward, x, use_reentrant=False)
+        return self._forward(x)
+
+    def _forward(self, x):
         # Self-attention with residual connection
         x = self.norm1(x)
         attn_out = self.attention(x)
@@ -172,7 +181,8 @@ class DiffusionEmbedding(nn.Module):
 
 
 class ResidualBlock(nn.Module):
-    def __init__(self, channels, diffusion_embedding_dim, nheads, side_dim=None, time_seq_len=50, feature_seq_len=11, compressed_dim=32):
+    def __init__(self, channels, diffusion_embedding_dim, nheads, side_dim=None, time_seq_len=50, feature_seq_len=11, compressed_dim=32,
+                 checkpoint_linformer=False):
         super().__init__()
         self.channels = channels
         self.side_dim = side_dim
@@ -180,9 +190,10 @@ class ResidualBlock(nn.Module):
         self.diffusion_projection = nn.Linear(diffusion_embedding_dim, channels)
 
         self.time_layer = get_linformer_trans(heads=nheads, layers=1, channels=channels, seq_len=time_seq_len, 
-                                              compressed_dim=compressed_dim, causal=True)
+                                              compressed_dim=compressed_dim, causal=True, use_checkpoint=checkpoint_linformer)
         self.feature_layer = get_linformer_trans(heads=nheads, layers=1, channels=channels, seq_len=feature_seq_len, 
-                                                 compressed_dim=min(compressed_dim, feature_seq_len), causal=False)
+                                                 compressed_dim=min(compressed_dim, feature_seq_len), causal=False,
+                                                 use_checkpoint=checkpoint_linformer)
         
         self.norm1 = nn.LayerNorm(channels)
         self.norm2 = nn.LayerNorm(channels)
@@ -284,6 +295,12 @@ class Diffoot_DenoisingNetwork(nn.Module):
         self.time_seq_len = config.get("time_seq_len", 50)
         self.feature_seq_len = config.get("feature_seq_len", 11) 
         self.compressed_dim = config.get("compressed_dim", 32)
+
+        # Activation checkpointing: int -> first n blocks, list -> block indices
+        checkpoint_blocks = config.get("checkpoint_blocks", 0)
+        if isinstance(checkpoint_blocks, int):
+            checkpoint_blocks = range(checkpoint_blocks)
+        self.checkpoint_blocks = set(checkpoint_blocks)
         
         self.dropout = nn.Dropout(0.2)
         self.norm = nn.LayerNorm(self.channels)
@@ -303,7 +320,8 @@ class Diffoot_DenoisingNetwork(nn.Module):
                 side_dim=self.side_dim,
                 time_seq_len=self.time_seq_len,
                 feature_seq_len=self.feature_seq_len,
-                compressed_dim=self.compressed_dim
+                compressed_dim=self.compressed_dim,
+                checkpoint_linformer=config.get("checkpoint_linformer", False)
             ) for _ in range(config["layers"])
         ])
         self.inv_sqrt_layers = 1.0 / math.sqrt(len(self.residual_layers))
@@ -326,10 +344,13 @@ class Diffoot_DenoisingNetwork(nn.Module):
 
         # # Aggregate skips
         x = x.reshape(B, self.channels, K, L)
-        skip_sum = torch.zeros_like(x)
+        skip_sum = torch.zeros_like(x, dtype=torch.float32)
 
-        for block in self.residual_layers:
-            x, skip = block(x, cond_info, diffusion_emb)
+        for i, block in enumerate(self.residual_layers):
+            if i in self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+                x, skip = checkpoint(block, x, cond_info, diffusion_emb, use_reentrant=False)
+            else:
+                x, skip = block(x, cond_info, diffusion_emb)
             skip_sum.add_(skip)
         x = skip_sum.mul_(self.inv_sqrt_layers)
         
@@ -1,33 +1,136 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch_geometric.nn import GATConv, HeteroConv
-from torch_geometric.data import HeteroData
+from torch_geometric.nn.inits import glorot
 from torch_geometric.utils import softmax
 
+from utils.graph_utils import SPATIAL_RELATIONS, DenseGraph
 
+
+# Pools node embeddings x [num_nodes, C] into one vector per graph, without host syncs:
+# - fixed-size graphs stored contiguously (group_size nodes each): reshape + softmax
+# - otherwise batch (graph id per node) and size (number of graphs, from the batch metadata): segment softmax / sum
 class AttentionPooling(nn.Module):
     def __init__(self, hidden_dim):
         super().__init__()
         self.query = nn.Parameter(torch.randn(hidden_dim) * 0.02)
 
-    def forward(self, x, batch):
+    def forward(self, x, batch=None, size=None, group_size=None):
+        # fp32 scores / softmax under autocast
+        x = x.float()
+        C = x.size(-1)
+        if group_size is not None:
+            x = x.view(-1, group_size, C)
+            weights = torch.softmax((x * self.query).sum(-1), dim=-1)
+            return (weights.unsqueeze(-1) * x).sum(1)
+
         scores = (x * self.query).sum(-1)
-        weights = softmax(scores, batch)
+        weights = softmax(scores, batch, num_nodes=size)
         out = weights.unsqueeze(-1) * x
 
-        B = int(batch.max().item()) + 1
-        C = x.size(-1)
-
-        pool = out.new_zeros((B, C))
+        pool = out.new_zeros((size, C))
         pool.index_add_(0, batch, out)
 
         return pool
 
 
+# HeteroConv({rel: GATConv(heads=1, concat=False, add_self_loops=False)}, aggr='sum') over one node type,
+# fused: the projections of all R relations are one matmul (the attention logits a second, small one), and the
+# attention softmax runs per (destination node, relation) over a single edge list tagged with relation ids.
+# Loads HeteroConv state dicts (convs.<Node___rel___Node>.*) as well.
+class RelationalGAT(nn.Module):
+    def __init__(self, in_channels, out_channels, relations, dropout=0.1, negative_slope=0.2):
+        super().__init__()
+        self.relations = list(relations)
+        self.dropout = dropout
+        self.negative_slope = negative_slope
+        R = len(self.relations)
+        self.weight = nn.Parameter(torch.empty(R, out_channels, in_channels))
+        self.att_src = nn.Parameter(torch.empty(R, out_channels))
+        self.att_dst = nn.Parameter(torch.empty(R, out_channels))
+        self.bias = nn.Parameter(torch.zeros(R, out_channels))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        glorot(self.weight)
+        glorot(self.att_src.unsqueeze(1))
+        glorot(self.att_dst.unsqueeze(1))
+        nn.init.zeros_(self.bias)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        old_prefixes = [f"{prefix}convs.<Node___{rel}___Node>." for rel in self.relations]
+        if old_prefixes[0] + 'lin.weight' in state_dict:
+            for name, old_name in (('weight', 'lin.weight'), ('att_src', 'att_src'), ('att_dst', 'att_dst'), ('bias', 'bias')):
+                shape = getattr(self, name).shape[1:]
+                state_dict[prefix + name] = torch.stack([state_dict.pop(p + old_name).reshape(shape) for p in old_prefixes])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    # x: [..., C] -> h [..., R, C_out], attention logits a_src / a_dst [..., R] (fp32)
+    def project(self, x):
+        h = F.linear(x, self.weight.flatten(0, 1)).unflatten(-1, (len(self.relations), -1))
+        # logits straight from x: att . (W x) = (att W) . x
+        att = torch.cat([torch.einsum('rc,rci->ri', self.att_src, self.weight),
+                         torch.einsum('rc,rci->ri', self.att_dst, self.weight)])
+        a_src, a_dst = F.linear(x, att).float().chunk(2, dim=-1)
+        return h, a_src, a_dst
+
+    # x: [N, C], edge_index: [2, E] (src, dst), edge_type: [E] index into self.relations -> [N, C_out]
+    def forward(self, x, edge_index, edge_type):
+        N, R = x.size(0), len(self.relations)
+        h, a_src, a_dst = self.project(x)
+        # flat (node, relation) indices into h.view(N * R, C)
+        src = edge_index[0] * R + edge_type
+        dst = edge_index[1] * R + edge_type
+        alpha = F.leaky_relu(a_src.reshape(-1).index_select(0, src) + a_dst.reshape(-1).index_select(0, dst), self.negative_slope)
+        alpha = softmax(alpha, dst, num_nodes=N * R)
+        alpha = F.dropout(alpha, p=self.dropout, training=self.training)
+
+        msg = alpha.unsqueeze(-1).to(h.dtype) * h.reshape(N * R, -1).index_select(0, src)
+        out = msg.new_zeros((N, h.size(-1))).index_add_(0, edge_index[1], msg)
+        return out + self.bias.sum(0)
+
+    # DenseGraph form. x: [B, T, N, C], adj: [B, R_s, T, N(dst), N(src)] edge counts of the first R_s relations;
+    # a 'temporal' relation (node i at t-1 -> node i at t) is implicit -> [B, T, N, C_out]
+    def forward_dense(self, x, adj):
+        R_s = adj.size(1)
+        h, a_src, a_dst = self.project(x)                                                     # [B, T, N, R, C]
+        h_s = h[..., :R_s, :].transpose(-3, -2)                                               # [B, T, R_s, N, C]
+        a_src = a_src[..., :R_s].transpose(-2, -1)                                            # [B, T, R_s, N]
+        a_dst = a_dst[..., :R_s].transpose(-2, -1)
+
+        adj = adj.transpose(1, 2)                                                             # [B, T, R_s, N, N]
+        e = F.leaky_relu(a_dst.unsqueeze(-1) + a_src.unsqueeze(-2), self.negative_slope)
+        e = e.masked_fill(adj == 0, float('-inf'))
+        # softmax over incoming edges (duplicate edges counted), nodes without edges only get the bias
+        e_max = e.amax(-1, keepdim=True).clamp(min=-1e30)
+        alpha = adj * (e - e_max).exp()
+        alpha = alpha / (alpha.sum(-1, keepdim=True) + 1e-16)
+        alpha = F.dropout(alpha, p=self.dropout, training=self.training)
+
+        # sum over relations inside the matmul: [B, T, N, R_s*N] @ [B, T, R_s*N, C]
+        alpha = alpha.transpose(-3, -2).flatten(-2).to(h.dtype)
+        out = torch.matmul(alpha, h_s.flatten(-3, -2))
+
+        if 'temporal' in self.relations:
+            # a single incoming edge: attention weight 1
+            h_t = h[..., self.relations.index('temporal'), :]
+            keep = F.dropout(h_t.new_ones(h_t.shape[:-1] + (1,)), p=self.dropout, training=self.training)
+            out = out + torch.cat([torch.zeros_like(h_t[:, :1]), keep[:, 1:] * h_t[:, :-1]], dim=1)
+        return out + self.bias.sum(0)
+
+
+# mode='flat': GAT over the whole [T x 23]-node graph (spatial + temporal edges), one attention pooling over all nodes.
+# mode='hierarchical': every `temporal_stride`-th frame is encoded spatially (no temporal edges),
+# pooled per frame, and the frame sequence is summarized by a GRU + attention pooling over time.
+# forward() takes either the sparse HeteroData (batch) or a DenseGraph (graph_utils.build_dense_graph_from_condition);
+# both use the same (RelationalGAT) weights, the dense path runs every relation as a batched [23 x 23] attention matmul.
 class InteractionGraphEncoder(nn.Module):
-    def __init__(self, in_dim, pos_emb_dim=8, hidden_dim=128, out_dim=128):
+    def __init__(self, in_dim, pos_emb_dim=8, hidden_dim=128, out_dim=128, mode='flat', temporal_stride=10, nodes_per_frame=23):
         super().__init__()
+        assert mode in ('flat', 'hierarchical')
+        self.mode = mode
+        self.temporal_stride = temporal_stride
+        self.nodes_per_frame = nodes_per_frame
         # normalization and pooling
         self.norm1 = nn.LayerNorm(hidden_dim)
         self.norm2 = nn.LayerNorm(hidden_dim)
@@ -37,92 +140,102 @@ class InteractionGraphEncoder(nn.Module):
         self.position_emb = nn.Embedding(24, pos_emb_dim)
         self.in_dim = in_dim - 1 + pos_emb_dim
 
-        # define edge types
-        edge_types = [
-            ('Node', 'attk_and_attk', 'Node'),
-            ('Node', 'attk_and_def', 'Node'),
-            ('Node', 'def_and_def', 'Node'),
-            ('Node', 'attk_and_ball', 'Node'),
-            ('Node', 'def_and_ball', 'Node'),
-            ('Node', 'temporal', 'Node'),
-        ]
-
-        conv1 = { rel: GATConv(
-                    in_channels=self.in_dim,
-                    out_channels=hidden_dim,
-                    heads=1,
-                    concat=False,
-                    add_self_loops=False,
-                    dropout=0.1
-                ) for rel in edge_types }
-
-        conv2 = { rel: GATConv(
-                    in_channels=hidden_dim,
-                    out_channels=hidden_dim,
-                    heads=1,
-                    concat=False,
-                    add_self_loops=False,
-                    dropout=0.1
-                ) for rel in edge_types }
-        self.het1 = HeteroConv(conv1, aggr='sum')
-        self.het2 = HeteroConv(conv2, aggr='sum')
+        # define edge types (spatial relations in DenseGraph.adj order)
+        edge_types = [('Node', rel, 'Node') for _, _, rel in SPATIAL_RELATIONS] + [('Node', 'temporal', 'Node')]
+        if mode == 'hierarchical':
+            edge_types = edge_types[:-1]
+        self.edge_types = edge_types
+
+        relations = [rel for _, rel, _ in edge_types]
+        self.het1 = RelationalGAT(self.in_dim, hidden_dim, relations, dropout=0.1)
+        self.het2 = RelationalGAT(hidden_dim, hidden_dim, relations, dropout=0.1)
         self.proj = nn.Linear(hidden_dim, out_dim)
 
-    def forward(self, graph: HeteroData):
-        x_all = graph['Node'].x
+        if mode == 'hierarchical':
+            self.temporal_rnn = nn.GRU(hidden_dim, hidden_dim, batch_first=True)
+            self.temporal_pool = AttentionPooling(hidden_dim)
+
+    # Keep every temporal_stride-th frame: node features [B*T*N, F] -> [B*T'*N, F], spatial edges re-indexed
+    def subsample_frames(self, x, edge_index, edge_type, num_graphs):
+        N, stride = self.nodes_per_frame, self.temporal_stride
+        T = x.size(0) // (num_graphs * N)
+        T_kept = (T + stride - 1) // stride
+        x = x.view(num_graphs, T, N, -1)[:, ::stride].reshape(num_graphs * T_kept * N, -1)
+
+        frame = edge_index[0] // N  # spatial edges never cross frames
+        keep = (frame % T) % stride == 0
+        edge_index = edge_index[:, keep]
+        frame = edge_index // N
+        edge_index = ((frame // T) * T_kept + (frame % T) // stride) * N + edge_index % N
+        return x, edge_index, edge_type[keep], T_kept
+
+    # edge_index_dict of self.edge_types -> one edge list [2, E] + relation ids [E]
+    def relation_edges(self, edge_index_dict):
+        edge_index = [edge_index_dict[rel] for rel in self.edge_types]
+        edge_type = [torch.full((e.size(1),), r, dtype=torch.long, device=e.device) for r, e in enumerate(edge_index)]
+        return torch.cat(edge_index, dim=1), torch.cat(edge_type)
+
+    def embed_nodes(self, x_all):
         # possession Encoding (with Learnable Parameter)
         pos_idx = 5                  
-        cont = torch.cat([x_all[:, :pos_idx], x_all[:, pos_idx+1:]], dim=1)
-        pos_raw = x_all[:, pos_idx].long()
+        cont = torch.cat([x_all[..., :pos_idx], x_all[..., pos_idx+1:]], dim=-1)
+        pos_raw = x_all[..., pos_idx].long()
 
         pos_idx_emb = pos_raw.clamp(min=0)
         pos_emb = self.position_emb(pos_idx_emb)
 
-        x = torch.cat([cont, pos_emb], dim=1)
+        return torch.cat([cont, pos_emb], dim=-1)
 
-        x_dict = {'Node': x}
+    # DenseGraph batch -> node embeddings [B, T', N, C]
+    def forward_dense(self, graph: DenseGraph):
+        x = self.embed_nodes(graph.x)
+        adj = graph.adj
+        if self.mode == 'hierarchical':
+            x = x[:, ::self.temporal_stride]
+            adj = adj[:, :, ::self.temporal_stride]
 
-        x_dict = self.het1(x_dict, graph.edge_index_dict, edge_attr_dict=graph.edge_attr_dict)
-        x = x_dict['Node']
+        x = self.norm1(self.dropout(F.gelu(self.het1.forward_dense(x, adj))))
+        x = self.norm2(self.dropout(F.gelu(self.het2.forward_dense(x, adj))))
+        return x
+
+    def forward(self, graph):
+        if isinstance(graph, DenseGraph):
+            x = self.forward_dense(graph)
+            num_graphs, num_frames = x.shape[:2]
+            return self.pool_nodes(x.reshape(-1, x.size(-1)), num_graphs, num_frames)
+
+        x = self.embed_nodes(graph['Node'].x)
+
+        edge_index, edge_type = self.relation_edges(graph.edge_index_dict)
+        num_graphs = getattr(graph, 'num_graphs', 1)
+        if self.mode == 'hierarchical':
+            x, edge_index, edge_type, num_frames = self.subsample_frames(x, edge_index, edge_type, num_graphs)
+
+        x = self.het1(x, edge_index, edge_type)
         x = F.gelu(x)
         x = self.dropout(x)
         x = self.norm1(x)
 
-        x_dict = self.het2({'Node': x}, graph.edge_index_dict, edge_attr_dict=graph.edge_attr_dict)
-        x = x_dict['Node']
+        x = self.het2(x, edge_index, edge_type)
         x = F.gelu(x)
         x = self.dropout(x)
         x = self.norm2(x)
 
-        # pooling
-        batch = graph['Node'].batch
-        graph_rep = self.pool(x, batch)
+        if self.mode == 'hierarchical':
+            return self.pool_nodes(x, num_graphs, num_frames)
+        return self.pool_nodes(x, num_graphs, batch=graph['Node'].batch)
+
+    # node embeddings [num_nodes, C] -> graph representation [B, out_dim]
+    # batch=None: num_frames * nodes_per_frame nodes per graph, stored graph by graph
+    def pool_nodes(self, x, num_graphs, num_frames=None, batch=None):
+        if self.mode == 'hierarchical':
+            # nodes -> frames -> sequence
+            frame_rep = self.pool(x, group_size=self.nodes_per_frame).view(num_graphs, num_frames, -1)
+            seq, _ = self.temporal_rnn(frame_rep)
+            graph_rep = self.temporal_pool(seq.reshape(num_graphs * num_frames, -1), group_size=num_frames)
+        elif batch is None:
+            graph_rep = self.pool(x, group_size=num_frames * self.nodes_per_frame)
+        else:
+            graph_rep = self.pool(x, batch, size=num_graphs)
         graph_rep = self.dropout(graph_rep)
         return self.proj(graph_rep)
-
-
-# class TargetTrajectoryEncoder(nn.Module):
-#     def __init__(self, input_dim = 46, hidden_dim = 64, num_layers = 1, bidirectional = True, rnn_type = "gru"):
-#         super().__init__()
-#         self.rnn_type = rnn_type.lower()
-#         self.num_directions = 2 if bidirectional else 1
-#         self.hidden_dim = hidden_dim
-#         rnn_cls = nn.LSTM if self.rnn_type == "lstm" else nn.GRU
-
-#         self.rnn = rnn_cls(input_size=input_dim, hidden_size=hidden_dim, num_layers=num_layers, batch_first=True, bidirectional=bidirectional)
-        
-#         self.dropout = nn.Dropout(0.1)
-#         self.layernorm = nn.LayerNorm(hidden_dim * self.num_directions)
-        
-#     def forward(self, x: torch.Tensor) -> torch.Tensor:
-#         _, h_n = self.rnn(x)
-#         if self.rnn_type == "lstm":
-#             h_n = h_n[0]
-
-#         last = h_n.view(self.rnn.num_layers, self.num_directions, x.size(0), self.hidden_dim)[-1]
-
-#         concat = last.permute(1, 0, 2).reshape(x.size(0), -1)  # (B, hidden_dim * num_directions)
-#         concat = self.dropout(concat)
-#         concat = self.layernorm(concat)
-        
-#         return concat
\ No newline at end of file
@@ -0,0 +1,489 @@
+import io
+import os
+import gc
+import glob
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from tqdm.auto import tqdm
+
+from utils.utils import get_autocast, StepTimer, is_distributed, get_rank, barrier
+from utils.async_plot import TopBottomK
+from utils.metrics import denorm_players, rel_to_absolute, trajectory_metrics, best_of_n, MetricAggregator
+from utils.data_utils import DevicePrefetcher, target_condition_indices
+
+# Train / validation / test stages of Diffoot + InteractionGraphEncoder (driven by main_for_Diffoot.py).
+# Checkpoints hold the full training state (models, optimizer, scheduler, scaler, losses, RNG states):
+# - save_dir/checkpoints/epoch_XXXX.pth every `checkpoint_every` epochs, only the last `keep_last_k` are kept
+# - save_dir/best_model.pth on a new best val loss (also what eval / distill load)
+# resume() continues from the latest one. Writes go through a CPU snapshot + background thread, and are atomic.
+# Under torch.distributed (see utils.init_distributed) both models are wrapped in DDP for training, epoch losses
+# are averaged over all ranks, and only rank 0 logs and writes checkpoints (RNG states are kept per rank).
+# Validation runs every `val_every` epochs (and after the last one), skipped epochs have a NaN val loss and do not
+# step the scheduler. With a utils.data_utils.FixedValidationSet it uses the cached per-sample t / noise.
+
+
+def _to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _atomic_save(obj, path):
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+# One background write at a time: submit() waits for the previous one and re-raises its error
+class AsyncCheckpointWriter:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.thread = None
+        self.error = None
+
+    def submit(self, fn):
+        self.wait()
+        if not self.enabled:
+            fn()
+            return
+
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                self.error = e
+
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+class Trainer:
+    def __init__(self, diff_model, graph_encoder, optimizer, scheduler, scaler, device, save_dir, hyperparams,
+                 zscore_stats, logger, generator=None):
+        self.diff_model = diff_model
+        self.graph_encoder = graph_encoder
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.scaler = scaler
+        self.device = device
+        self.hyperparams = hyperparams
+        self.zscore_stats = zscore_stats
+        self.logger = logger
+        self.generator = generator  # train DataLoader generator: the shuffle order resumes with it
+        self.rank = get_rank()
+        self.is_main = self.rank == 0
+
+        # training forward passes go through the DDP wrappers (gradient all-reduce), everything else uses the modules
+        self.train_diff_model, self.train_graph_encoder = diff_model, graph_encoder
+        if is_distributed():
+            device_ids = [device] if torch.device(device).type == 'cuda' else None
+            self.train_diff_model = DDP(diff_model, device_ids=device_ids)
+            self.train_graph_encoder = DDP(graph_encoder, device_ids=device_ids)
+
+        self.amp_dtype = hyperparams.get('amp_dtype')
+        self.log_interval = hyperparams.get('log_interval', 50)
+        self.keep_last_k = hyperparams.get('keep_last_k', 3)
+        if self.keep_last_k < 1:
+            raise ValueError(f"keep_last_k must be >= 1 (resume needs a periodic checkpoint), got {self.keep_last_k}")
+        self.checkpoint_every = hyperparams.get('checkpoint_every', 1)
+        self.val_every = hyperparams.get('val_every', 1)
+        self.timer = StepTimer(device, enabled=hyperparams.get('step_timer', False))
+        self.writer = AsyncCheckpointWriter(enabled=hyperparams.get('async_checkpoint', True))
+
+        self.checkpoint_dir = os.path.join(save_dir, 'checkpoints')
+        self.best_path = os.path.join(save_dir, 'best_model.pth')
+        if self.is_main:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        self.epoch = 0
+        self.best_val_loss = float("inf")
+        self.train_losses = []
+        self.val_losses = []
+
+    # --- Checkpointing ---
+    def rng_state(self):
+        np_state = np.random.get_state()
+        return {
+            'python': random.getstate(),
+            'numpy': (np_state[0], torch.from_numpy(np_state[1].copy()), *np_state[2:]),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'loader': self.generator.get_state() if self.generator is not None else None,
+        }
+
+    def set_rng_state(self, rng):
+        random.setstate(rng['python'])
+        np.random.set_state((rng['numpy'][0], rng['numpy'][1].numpy(), *rng['numpy'][2:]))
+        torch.set_rng_state(rng['torch'])
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng['cuda'])
+        if rng['loader'] is not None and self.generator is not None:
+            self.generator.set_state(rng['loader'])
+
+    # RNG states of all ranks, one entry per rank (collective under DDP)
+    def gather_rng_state(self):
+        if not is_distributed():
+            return [self.rng_state()]
+        buffer = io.BytesIO()
+        torch.save(self.rng_state(), buffer)
+        gathered = [None] * dist.get_world_size()
+        dist.all_gather_object(gathered, buffer.getvalue())
+        return [torch.load(io.BytesIO(b), map_location='cpu') for b in gathered]
+
+    # rng: gather_rng_state() output (None: gathered here, a collective under DDP)
+    def state_dict(self, rng=None):
+        if rng is None:
+            rng = self.gather_rng_state()
+        return {
+            'epoch': self.epoch,
+            'diff_model': self.diff_model.state_dict(),
+            'graph_encoder': self.graph_encoder.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'best_val_loss': self.best_val_loss,
+            'train_losses': self.train_losses,
+            'val_losses': self.val_losses,
+            'zscore_stats': self.zscore_stats,
+            'hyperparams': self.hyperparams,
+            'rng': rng, # one entry per rank
+        }
+
+    def load_state_dict(self, state):
+        self.diff_model.load_state_dict(state['diff_model'])
+        self.graph_encoder.load_state_dict(state['graph_encoder'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        if 'scaler' in state:
+            self.scaler.load_state_dict(state['scaler'])
+        self.epoch = state['epoch']
+        self.best_val_loss = state['best_val_loss']
+        self.train_losses = list(state['train_losses'])
+        self.val_losses = list(state['val_losses'])
+
+        # RNG states are only restored for the same number of ranks
+        rng = state.get('rng')
+        if rng is not None and len(rng) == (dist.get_world_size() if is_distributed() else 1):
+            self.set_rng_state(rng[self.rank])
+
+    def checkpoint_path(self, epoch):
+        return os.path.join(self.checkpoint_dir, f"epoch_{epoch:04d}.pth")
+
+    def latest_checkpoint(self):
+        paths = sorted(glob.glob(os.path.join(self.checkpoint_dir, "epoch_*.pth")))
+        return paths[-1] if paths else None
+
+    # Called on every rank (same is_best everywhere), only rank 0 writes
+    def save_checkpoint(self, is_best=False):
+        write_periodic = self.epoch % self.checkpoint_every == 0
+        if not (write_periodic or is_best):
+            return
+        # every rank takes part in the RNG gather, only rank 0 snapshots the rest
+        rng = self.gather_rng_state()
+        if not self.is_main:
+            return
+        # the snapshot is taken now; training continues while it is written
+        snapshot = _to_cpu(self.state_dict(rng))
+        path = self.checkpoint_path(self.epoch)
+
+        def write():
+            if write_periodic:
+                _atomic_save(snapshot, path)
+                files = sorted(glob.glob(os.path.join(self.checkpoint_dir, "epoch_*.pth")))
+                for old in files[:max(len(files) - self.keep_last_k, 0)]:
+                    os.remove(old)
+            if is_best:
+                if write_periodic:
+                    shutil.copyfile(path, self.best_path + ".tmp")
+                    os.replace(self.best_path + ".tmp", self.best_path)
+                else:
+                    _atomic_save(snapshot, self.best_path)
+
+        self.writer.submit(write)
+
+    # Continue from `path` (default: latest periodic checkpoint); returns False if there is none
+    def resume(self, path=None):
+        path = path or self.latest_checkpoint()
+        if path is None:
+            return False
+        # on CPU: RNG states must stay CPU tensors, load_state_dict of the models / optimizer moves the rest
+        self.load_state_dict(torch.load(path, map_location='cpu'))
+        if self.is_main:
+            self.logger.info(f"Resumed from {path} (epoch {self.epoch})")
+        return True
+
+    # Model weights of best_model.pth, for the val / test stages
+    def load_best(self):
+        self.writer.wait()
+        state = torch.load(self.best_path, map_location='cpu')  # load_state_dict copies onto the model's device
+        self.diff_model.load_state_dict(state['diff_model'])
+        self.graph_encoder.load_state_dict(state['graph_encoder'])
+        if self.is_main:
+            self.logger.info(f"Loaded {self.best_path} (epoch {state['epoch']}, val loss {state['best_val_loss']:.6f})")
+
+    # Epoch means of the per-batch losses, over all ranks under DDP
+    def _epoch_means(self, totals, num_batches):
+        stats = torch.tensor([float(v) for v in totals.values()] + [num_batches], dtype=torch.float64, device=self.device)
+        if is_distributed():
+            dist.all_reduce(stats)
+        return {k: (v / stats[-1]).item() for k, v in zip(totals, stats)}
+
+    # --- Stages ---
+    def train_epoch(self, loader):
+        self.diff_model.train()
+        self.graph_encoder.train()
+        device = self.device
+
+        train_loss_v = 0
+        train_noise_nll = 0
+        train_loss = 0
+
+        # losses are summed on device, synced only every log_interval steps and at the end of the epoch
+        progress = tqdm(DevicePrefetcher(loader, device), desc = "Batch Training...", leave=False, disable=not self.is_main)
+        self.timer.start()
+        for step, batch in enumerate(progress, 1):
+            self.timer.mark('data')
+            _, T_target, _ = batch["target"].shape
+            target_rel = batch["target_relative"].to(device).view(-1, T_target, 11, 2)  # [B, T, 11, 2]
+            graph_batch = batch["graph"].to(device) # HeteroData / DenseGraph batch
+            self.timer.mark('h2d')
+            with get_autocast(device, self.amp_dtype):
+                # graph → H
+                H = self.train_graph_encoder(graph_batch) # [B, 256]
+                cond_info = H.unsqueeze(-1).unsqueeze(-1).expand(-1, H.size(1), 11, T_target)
+
+                # timestep (consistency)
+                t = torch.randint(0, self.diff_model.num_steps, (target_rel.size(0),), device=device)
+
+                loss_v, noise_nll = self.train_diff_model(target_rel, t=t, cond_info=cond_info)
+            loss = loss_v + noise_nll * 0.001
+            self.timer.mark('forward')
+
+            self.optimizer.zero_grad()
+            self.scaler.scale(loss).backward()
+            self.timer.mark('backward')
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.timer.mark('optimizer')
+            self.timer.step()
+
+            train_loss_v += loss_v.detach()
+            train_noise_nll += (noise_nll * 0.001).detach()
+            train_loss += loss.detach()
+            if self.log_interval and step % self.log_interval == 0:
+                progress.set_postfix(loss=f"{train_loss.item() / step:.6f}")
+
+            del target_rel, graph_batch, H, cond_info, t, loss_v, noise_nll
+
+        if self.timer.enabled:
+            if self.is_main:
+                self.logger.info(f"[Epoch {self.epoch + 1}] Step time: {self.timer.summary()}")
+            self.timer.reset()
+        return self._epoch_means({'loss': train_loss, 'loss_v': train_loss_v, 'noise_nll': train_noise_nll}, len(loader))
+
+    def validate(self, loader):
+        self.diff_model.eval()
+        self.graph_encoder.eval()
+        device = self.device
+
+        val_loss_v = 0
+        val_noise_nll = 0
+        val_total_loss = 0
+
+        with torch.no_grad():
+            for batch in tqdm(DevicePrefetcher(loader, device), desc="Validation", leave=False, disable=not self.is_main):
+                _, T_target, _ = batch["target"].shape
+                target_rel = batch["target_relative"].to(device).view(-1, T_target, 11, 2)  # [B, T, 11, 2]
+                graph_batch = batch["graph"].to(device) # HeteroData / DenseGraph batch
+
+                with get_autocast(device, self.amp_dtype):
+                    # graph → H
+                    H = self.graph_encoder(graph_batch) # [B, 256]
+                    cond_info = H.unsqueeze(-1).unsqueeze(-1).expand(-1, H.size(1), 11, T_target)
+
+                    # fixed validation set: seeded per-sample t / noise, otherwise drawn fresh
+                    if "t" in batch:
+                        t, noise = batch["t"], batch["noise"]
+                    else:
+                        t = torch.randint(0, self.diff_model.num_steps, (target_rel.size(0),), device=device)
+                        noise = None
+
+                    loss_v, noise_nll = self.diff_model(target_rel, t=t, cond_info=cond_info, noise=noise)
+                val_loss = loss_v + noise_nll * 0.001
+
+                val_loss_v += loss_v
+                val_noise_nll += noise_nll * 0.001
+                val_total_loss += val_loss
+
+        return self._epoch_means({'loss': val_total_loss, 'loss_v': val_loss_v, 'noise_nll': val_noise_nll}, len(loader))
+
+    # Epochs self.epoch + 1 .. epochs (continues a resumed run)
+    def fit(self, train_loader, val_loader, epochs):
+        for epoch in tqdm(range(self.epoch + 1, epochs + 1), desc="Training...", leave=True, disable=not self.is_main):
+            # DistributedSampler: a new shuffle per epoch, same on every rank
+            if hasattr(train_loader.sampler, 'set_epoch'):
+                train_loader.sampler.set_epoch(epoch)
+            train = self.train_epoch(train_loader)
+            self.epoch = epoch
+            self.train_losses.append(train['loss'])
+            current_lr = self.scheduler.get_last_lr()[0]
+
+            if epoch % self.val_every != 0 and epoch != epochs:
+                self.val_losses.append(float("nan"))
+                if self.is_main:
+                    self.logger.info(f"[Epoch {epoch}/{epochs}] Train Loss={train['loss']:.6f} (Noise simple={train['loss_v']:.6f}, Noise NLL={train['noise_nll']:.6f}) | LR={current_lr:.6e}")
+                    tqdm.write(f"[Epoch {epoch}]\n"
+                               f"[Train] Cost: {train['loss']:.6f} | Noise Loss: {train['loss_v']:.6f} | NLL Loss: {train['noise_nll']:.6f} | LR: {current_lr:.6f}")
+                self.save_checkpoint()
+                continue
+
+            val = self.validate(val_loader)
+            self.val_losses.append(val['loss'])
+
+            if self.is_main:
+                self.logger.info(f"[Epoch {epoch}/{epochs}] Train Loss={train['loss']:.6f} (Noise simple={train['loss_v']:.6f}, Noise NLL={train['noise_nll']:.6f}) | "
+                                 f"Val Loss={val['loss']:.6f} (Noise simple={val['loss_v']:.6f}, Noise NLL={val['noise_nll']:.6f}) | LR={current_lr:.6e}")
+
+                tqdm.write(f"[Epoch {epoch}]\n"
+                           f"[Train] Cost: {train['loss']:.6f} | Noise Loss: {train['loss_v']:.6f} | NLL Loss: {train['noise_nll']:.6f} | LR: {current_lr:.6f}\n"
+                           f"[Validation] Val Loss: {val['loss']:.6f} | Noise Loss: {val['loss_v']:.6f} | NLL Loss: {val['noise_nll']:.6f}")
+
+            self.scheduler.step(val['loss'])
+
+            is_best = val['loss'] < self.best_val_loss
+            if is_best:
+                self.best_val_loss = val['loss']
+            self.save_checkpoint(is_best=is_best)
+
+            torch.cuda.empty_cache()
+            gc.collect()
+
+        self.writer.wait()
+        barrier() # checkpoints are on disk for every rank
+        if self.is_main:
+            self.logger.info(f"Training complete. Best val loss: {self.best_val_loss:.6f}")
+
+    # Best-of-N sampling on the test set, plots of the k best / worst (or all) samples under base_dir.
+    # plotter: an AsyncPlotter created before any loader / thread started (closed here)
+    def test(self, loader, num_samples, ddim_step, eta, base_dir, plotter, cuda_graph=False, plot_k=16):
+        self.diff_model.eval()
+        self.graph_encoder.eval()
+        device, zscore_stats = self.device, self.zscore_stats
+
+        avg_stats = MetricAggregator()
+        min_stats = MetricAggregator()
+
+        # other players + ball de-normalization stats, [2] each
+        player_mean = torch.tensor([zscore_stats['player_x_mean'], zscore_stats['player_y_mean']], device=device)
+        player_std = torch.tensor([zscore_stats['player_x_std'], zscore_stats['player_y_std']], device=device)
+        ball_mean = torch.tensor([zscore_stats['ball_x_mean'], zscore_stats['ball_y_mean']], device=device)
+        ball_std = torch.tensor([zscore_stats['ball_x_std'], zscore_stats['ball_y_std']], device=device)
+
+        # Plots are rendered by background workers; with plot_k only the k best / worst samples are kept
+        os.makedirs(base_dir, exist_ok=True)
+        plot_selector = TopBottomK(plot_k) if plot_k is not None else None
+
+        with torch.no_grad():
+            for batch_idx, batch in enumerate(tqdm(DevicePrefetcher(loader, device), desc="Test Streaming Inference", leave=True)):
+                cond = batch["condition"].to(device)
+                B, T_cond, _ = cond.shape
+                _, T_target, _ = batch["target"].shape
+                target_columns = batch["target_columns"][0]
+                condition_columns = batch["condition_columns"][0]
+
+                target_x_indices, target_y_indices = target_condition_indices(tuple(target_columns), tuple(condition_columns))
+
+                last_past_cond = cond[:, -1]
+
+                initial_pos = torch.stack([
+                    last_past_cond[:, target_x_indices],  # [B, 11]
+                    last_past_cond[:, target_y_indices]   # [B, 11]
+                ], dim=-1)  # [B, 11, 2]
+
+                target_abs = batch["target"].to(device).view(-1, T_target, 11, 2)  # [B, T_target, 11, 2]
+                target_rel = batch["target_relative"].to(device).view(-1, T_target, 11, 2)  # [B, T_target, 11, 2]
+
+                with get_autocast(device, self.amp_dtype):
+                    H = self.graph_encoder(batch["graph"].to(device))
+                    cond_info = H.unsqueeze(-1).unsqueeze(-1).expand(-1, H.size(1), 11, T_target)
+
+                    preds = self.diff_model.generate(shape=target_rel.shape, cond_info=cond_info, ddim_steps=ddim_step, eta=eta,
+                                                     num_samples=num_samples, cuda_graph=cuda_graph) # (S, B, T, 11, 2)
+
+                # Denormalization (once, shared by metrics and visualization)
+                ref_denorm = denorm_players(initial_pos, zscore_stats)
+                target_abs_denorm = denorm_players(target_abs, zscore_stats)
+                pred_absolute = rel_to_absolute(preds, ref_denorm, zscore_stats)  # [S, B, T, 11, 2]
+
+                # Evaluation
+                metrics = trajectory_metrics(pred_absolute, target_abs_denorm)  # [S, B]
+                avg_metrics = {k: v.mean(0) for k, v in metrics.items()}
+                min_metrics = best_of_n(metrics)  # Best-of-K methods
+                min_ade_indices = min_metrics['best_idx']
+
+                avg_stats.update(avg_metrics)
+                min_stats.update(min_metrics)
+
+                print(f"[Batch {batch_idx}] "
+                      f"Avg - ADE={avg_metrics['ade'].mean():.3f}, FDE={avg_metrics['fde'].mean():.3f}, "
+                      f"Frechet={avg_metrics['frechet'].mean():.3f}, DE={torch.rad2deg(avg_metrics['de'].mean()):.2f}° | "
+                      f"Min - ADE={min_metrics['ade'].mean():.3f}, FDE={min_metrics['fde'].mean():.3f}, "
+                      f"Frechet={min_metrics['frechet'].mean():.3f}, DE={torch.rad2deg(min_metrics['de'].mean()):.2f}°")
+
+                # Visualization
+                best_pred = pred_absolute[min_ade_indices, torch.arange(B, device=device)].cpu().numpy()  # [B, T, 11, 2]
+                target_np = target_abs_denorm.cpu().numpy()
+
+                other_seq = batch["other"].to(device).view(B, T_target, -1, 2)
+                is_ball = torch.tensor([[c == "ball_x" for c in cols[0::2]] for cols in batch["other_columns"]], device=device)[..., None]
+                other_mean = torch.where(is_ball, ball_mean, player_mean)  # [B, 12, 2]
+                other_std = torch.where(is_ball, ball_std, player_std)
+                other_np = (other_seq * other_std.unsqueeze(1) + other_mean.unsqueeze(1)).cpu().numpy()
+                min_ade_np = min_metrics['ade'].cpu().numpy()
+
+                for i in range(B):
+                    target_cols = batch["target_columns"][i]
+                    defender_nums = [int(col.split('_')[1]) for col in target_cols[::2]]
+                    plot_args = (other_np[i], target_np[i], best_pred[i], dict(
+                        other_columns=batch["other_columns"][i], defenders_num=defender_nums, annotate=True
+                    ))
+
+                    if plot_selector is None:
+                        folder = os.path.join(base_dir, f"batch_{batch_idx:03d}")
+                        os.makedirs(folder, exist_ok=True)
+                        plotter.submit(*plot_args[:3], save_path=os.path.join(folder, f"sample_{i:02d}.png"), **plot_args[3])
+                    else:
+                        plot_selector.add(float(min_ade_np[i]), (batch_idx, i, plot_args))
+
+                del preds, pred_absolute, target_abs_denorm, ref_denorm, metrics
+                del cond, target_rel, target_abs, initial_pos, H, cond_info
+                torch.cuda.empty_cache()
+                gc.collect()
+
+        if plot_selector is not None:
+            for name, selected in zip(("best", "worst"), plot_selector.results()):
+                folder = os.path.join(base_dir, name)
+                os.makedirs(folder, exist_ok=True)
+                for rank, (ade, (b_idx, i, plot_args)) in enumerate(selected):
+                    save_path = os.path.join(folder, f"{rank:02d}_batch_{b_idx:03d}_sample_{i:02d}_ade_{ade:.2f}.png")
+                    plotter.submit(*plot_args[:3], save_path=save_path, **plot_args[3])
+        plotter.close()
+
+        return {'avg': avg_stats.summary(), 'min': min_stats.summary()}
@@ -24,6 +24,8 @@ Main Functions
 load_EPV_grid(): load pregenerated EPV surface from file. 
 calculate_epv_added(): Calculates the expected possession value added by a pass
 find_max_value_added_target(): Finds the *maximum* expected possession value that could have been achieved for a pass (defined by the event_id) by searching the entire field for the best target.
+calculate_epv_added_for_passes(), find_max_value_added_targets(): batch versions of the two functions above for all passes of a match at once
+epv_report(): EPV-added and maximum EPV-added of every pass as a DataFrame
     
 
 @author: Laurie Shaw (@EightyFivePoint)
@@ -103,45 +105,9 @@ def calculate_epv_added( event_id, events, tracking_home, tracking_away, GK_numb
         EPV_difference: The raw change in EPV (ignoring pitch control) between end and start points of pass
 
     """
-    # pull out pass details from the event data
-    pass_start_pos = np.array([events.loc[event_id]['Start X'],events.loc[event_id]['Start Y']])
-    pass_target_pos = np.array([events.loc[event_id]['End X'],events.loc[event_id]['End Y']])
-    pass_frame = events.loc[event_id]['Start Frame']
-    pass_team = events.loc[event_id].Team
-    
-    # direction of play for atacking team (so we know whether to flip the EPV grid)
-    home_attack_direction = mio.find_playing_direction(tracking_home,'Home')
-    if pass_team=='Home':
-        attack_direction = home_attack_direction
-        attacking_players = mpc.initialise_players(tracking_home.loc[pass_frame],'Home',params,GK_numbers[0])
-        defending_players = mpc.initialise_players(tracking_away.loc[pass_frame],'Away',params,GK_numbers[1])
-    elif pass_team=='Away':
-        attack_direction = home_attack_direction*-1
-        defending_players = mpc.initialise_players(tracking_home.loc[pass_frame],'Home',params,GK_numbers[0])
-        attacking_players = mpc.initialise_players(tracking_away.loc[pass_frame],'Away',params,GK_numbers[1])    
-    # flag any players that are offside
-    attacking_players = mpc.check_offsides( attacking_players, defending_players, pass_start_pos, GK_numbers)
-    # pitch control grid at pass start location
-    Patt_start,_ = mpc.calculate_pitch_control_at_target(pass_start_pos, attacking_players, defending_players, pass_start_pos, params)
-    # pitch control grid at pass end location
-    Patt_target,_ = mpc.calculate_pitch_control_at_target(pass_target_pos, attacking_players, defending_players, pass_start_pos, params)
-    
-    # EPV at start location
-    EPV_start = get_EPV_at_location(pass_start_pos, EPV, attack_direction=attack_direction)
-    # EPV at end location
-    EPV_target   = get_EPV_at_location(pass_target_pos,EPV,attack_direction=attack_direction)
-    
-    # 'Expected' EPV at target and start location
-    EEPV_target = Patt_target*EPV_target
-    EEPV_start = Patt_start*EPV_start
-    
-    # difference is the (expected) EPV added
-    EEPV_added = EEPV_target - EEPV_start
-    
-    # Also calculate the straight up change in EPV
-    EPV_difference = EPV_target - EPV_start
-
-    return EEPV_added, EPV_difference
+    # evaluated as a batch of one pass (array based team states instead of player objects)
+    EEPV_added, EPV_difference = calculate_epv_added_for_passes(events, tracking_home, tracking_away, GK_numbers, EPV, params, event_ids=[event_id])
+    return EEPV_added[0], EPV_difference[0]
 
 def find_max_value_added_target( event_id, events, tracking_home, tracking_away, GK_numbers, EPV, params ):
     """ find_max_value_added_target
@@ -164,50 +130,156 @@ def find_max_value_added_target( event_id, events, tracking_home, tracking_away,
         max_target_location: (x,y) location of the position of the maxEPV_added
 
     """
-    # pull out pass details from the event data
-    pass_start_pos = np.array([events.loc[event_id]['Start X'],events.loc[event_id]['Start Y']])
-    pass_frame = events.loc[event_id]['Start Frame']
-    pass_team = events.loc[event_id].Team
+    # evaluated as a batch of one pass (vectorized pitch control surface)
+    maxEPV_added, max_target_location = find_max_value_added_targets(events, tracking_home, tracking_away, GK_numbers, EPV, params, event_ids=[event_id])
+    return maxEPV_added[0], tuple(max_target_location[0])
+
+""" Batch EPV functions """
+
+def get_EPV_at_locations(positions,EPV,attack_direction,field_dimen=(106.,68.)):
+    """ get_EPV_at_locations
     
+    Vectorized get_EPV_at_location: EPV values at many (x,y) locations with a single array lookup
+    
+    Parameters
+    -----------
+        positions: (...,2) array of pitch positions
+        EPV: tuple Expected Possession value grid (loaded using load_EPV_grid() )
+        attack_direction: Sets the attack direction (1: left->right, -1: right->left). Scalar or array broadcastable to positions.shape[:-1]
+        field_dimen: tuple containing the length and width of the pitch in meters. Default is (106,68)
+            
+    Returns
+    -----------
+        (...) array of EPV values at the input positions (zero for positions off the field)
+        
+    """
+    positions = np.asarray(positions, dtype=float)
+    x, y = positions[...,0], positions[...,1]
+    on_field = (np.abs(x)<=field_dimen[0]/2.) & (np.abs(y)<=field_dimen[1]/2.)
+    ny,nx = EPV.shape
+    dx = field_dimen[0]/float(nx)
+    dy = field_dimen[1]/float(ny)
+    ix = np.where( on_field, (x+field_dimen[0]/2.-0.0001)/dx, 0 ).astype(int)
+    iy = np.where( on_field, (y+field_dimen[1]/2.-0.0001)/dy, 0 ).astype(int)
+    # flipping the grid for right->left attacks is the same as mirroring the column index
+    ix = np.where( np.asarray(attack_direction)==-1, nx-1-ix, ix )
+    return np.where( on_field, EPV[iy,ix], 0.0 )
+
+def pass_team_states(event_ids, events, tracking_home, tracking_away, GK_numbers, params, offsides=True):
+    """ pass_team_states
+    
+    Attacking and defending team states (Metrica_PitchControl.TeamState) at the start frame of a set of passes, one frame per pass
+    
+    Returns
+    -----------
+        attacking_team, defending_team: TeamState of the team in possession (offside players flagged) and of the defending team
+        attack_direction: (n_passes,) direction of play of the team in possession (1: left->right, -1: right->left)
+
+    """
+    frames = events.loc[event_ids,'Start Frame'].to_numpy()
+    is_home = (events.loc[event_ids,'Team']=='Home').to_numpy()
+    assert np.all( is_home | (events.loc[event_ids,'Team']=='Away').to_numpy() ), "Team in possession must be either home or away"
+    home = mpc.TeamState.from_tracking(tracking_home,'Home',params,GK_numbers[0],frames)
+    away = mpc.TeamState.from_tracking(tracking_away,'Away',params,GK_numbers[1],frames)
+    assert home.is_gk.any() and away.is_gk.any(), "Goalkeeper jersey number not found in tracking data"
+    attacking_team = mpc.TeamState.where(is_home, home, away)
+    defending_team = mpc.TeamState.where(is_home, away, home)
+    if offsides:
+        attacking_team.check_offsides(defending_team, events.loc[event_ids,['Start X','Start Y']].to_numpy(dtype=float))
     # direction of play for atacking team (so we know whether to flip the EPV grid)
     home_attack_direction = mio.find_playing_direction(tracking_home,'Home')
-    if pass_team=='Home':
-        attack_direction = home_attack_direction
-        attacking_players = mpc.initialise_players(tracking_home.loc[pass_frame],'Home',params,GK_numbers[0])
-        defending_players = mpc.initialise_players(tracking_away.loc[pass_frame],'Away',params,GK_numbers[1])
-    elif pass_team=='Away':
-        attack_direction = home_attack_direction*-1
-        defending_players = mpc.initialise_players(tracking_home.loc[pass_frame],'Home',params,GK_numbers[0])
-        attacking_players = mpc.initialise_players(tracking_away.loc[pass_frame],'Away',params,GK_numbers[1])   
+    attack_direction = np.where( is_home, home_attack_direction, -home_attack_direction )
+    return attacking_team, defending_team, attack_direction
+
+def calculate_epv_added_for_passes( events, tracking_home, tracking_away, GK_numbers, EPV, params, event_ids=None):
+    """ calculate_epv_added_for_passes
+    
+    Batch version of calculate_epv_added: EPV-added of every pass in event_ids, with the pitch control at all pass start and end 
+    locations integrated together.
+    
+    Parameters
+    -----------
+        events: Dataframe containing the event data
+        tracking_home: tracking DataFrame for the Home team
+        tracking_away: tracking DataFrame for the Away team
+        GK_numbers: tuple containing the player id of the goalkeepers for the (home team, away team)
+        EPV: tuple Expected Possession value grid (loaded using load_EPV_grid() )
+        params: Dictionary of pitch control model parameters (default model parameters can be generated using default_model_params() )
+        event_ids: Indices (not rows) of the pass events. Default: all events of type 'PASS'
         
-    # flag any players that are offside
-    attacking_players = mpc.check_offsides( attacking_players, defending_players, pass_start_pos, GK_numbers)
+    Returns
+    -----------
+        EEPV_added: (n_passes,) Expected EPV value-added of each pass
+        EPV_difference: (n_passes,) The raw change in EPV (ignoring pitch control) between end and start points of each pass
+
+    """
+    if event_ids is None:
+        event_ids = events[events.Type=='PASS'].index
+    pass_start_pos = events.loc[event_ids,['Start X','Start Y']].to_numpy(dtype=float)
+    pass_target_pos = events.loc[event_ids,['End X','End Y']].to_numpy(dtype=float)
+    attacking_team, defending_team, attack_direction = pass_team_states(event_ids, events, tracking_home, tracking_away, GK_numbers, params)
+    
+    # pitch control at pass start and end locations
+    Patt,_ = mpc.integrate_team_pitch_control(np.stack([pass_start_pos,pass_target_pos],axis=1), attacking_team, defending_team, pass_start_pos, params)
+    Patt_start, Patt_target = Patt[:,0], Patt[:,1]
     
-    # pitch control grid at pass start location
-    Patt_start,_ = mpc.calculate_pitch_control_at_target(pass_start_pos, attacking_players, defending_players, pass_start_pos, params)
+    # EPV at start and end locations
+    EPV_start = get_EPV_at_locations(pass_start_pos, EPV, attack_direction)
+    EPV_target = get_EPV_at_locations(pass_target_pos, EPV, attack_direction)
     
-    # EPV at start location
-    EPV_start = get_EPV_at_location(pass_start_pos, EPV, attack_direction=attack_direction)
+    # difference of the 'Expected' EPV at target and start location is the (expected) EPV added
+    EEPV_added = Patt_target*EPV_target - Patt_start*EPV_start
+    EPV_difference = EPV_target - EPV_start
+    return EEPV_added, EPV_difference
 
-    # calculate pitch control surface at moment of the pass
-    PPCF,xgrid,ygrid = mpc.generate_pitch_control_for_event(event_id, events, tracking_home, tracking_away, params, GK_numbers, field_dimen = (106.,68.,), n_grid_cells_x = 50, offsides=True)
+def find_max_value_added_targets( events, tracking_home, tracking_away, GK_numbers, EPV, params, event_ids=None, chunk_size=32 ):
+    """ find_max_value_added_targets
     
-    # EPV surface at instance of the pass
-    if attack_direction == -1:
-        EEPV = np.fliplr(EPV)*PPCF
-    else:
-        EEPV = EPV*PPCF
+    Batch version of find_max_value_added_target, using the vectorized pitch control surfaces of Metrica_PitchControl.pitch_control_for_frames
+    
+    Parameters
+    -----------
+        events, tracking_home, tracking_away, GK_numbers, EPV, params: see calculate_epv_added_for_passes
+        event_ids: Indices (not rows) of the pass events. Default: all events of type 'PASS'
+        chunk_size: number of passes whose pitch control surfaces are evaluated together
         
-    # find indices of the maxEPV
-    maxEPV_idx = np.unravel_index(EEPV.argmax(),EEPV.shape)
+    Returns
+    -----------
+        maxEPV_added: (n_passes,) maximum EPV value-added that could be achieved at the instant of each pass
+        max_target_location: (n_passes,2) (x,y) location of the position of the maxEPV_added
+
+    """
+    if event_ids is None:
+        event_ids = events[events.Type=='PASS'].index
+    pass_start_pos = events.loc[event_ids,['Start X','Start Y']].to_numpy(dtype=float)
+    attacking_team, defending_team, attack_direction = pass_team_states(event_ids, events, tracking_home, tracking_away, GK_numbers, params)
     
-    # Expected EPV at current ball position   
-    EEPV_start = Patt_start*EPV_start
+    # pitch control and EPV at the current ball position
+    Patt_start,_ = mpc.integrate_team_pitch_control(pass_start_pos[:,None,:], attacking_team, defending_team, pass_start_pos, params)
+    EEPV_start = Patt_start[:,0]*get_EPV_at_locations(pass_start_pos, EPV, attack_direction)
     
-    # maxEPV_added (difference between max location and current ball location)
-    maxEPV_added = EEPV.max() - EEPV_start
+    # pitch control surfaces at the moment of each pass, on the same grid as the EPV surface
+    PPCF,xgrid,ygrid = mpc.pitch_control_surfaces(attacking_team, defending_team, pass_start_pos, params, field_dimen = (106.,68.,), 
+                                                  n_grid_cells_x = EPV.shape[1], chunk_size=chunk_size)
+    EEPV = np.where( (attack_direction==-1)[:,None,None], np.fliplr(EPV), EPV )*PPCF
     
-    # location of maximum
-    max_target_location = (xgrid[maxEPV_idx[1]], ygrid[maxEPV_idx[0]])
-
+    # find indices of the maxEPV
+    flat_idx = EEPV.reshape(len(EEPV),-1).argmax(axis=1)
+    iy, ix = np.unravel_index(flat_idx, EPV.shape)
+    maxEPV_added = EEPV.reshape(len(EEPV),-1)[np.arange(len(EEPV)),flat_idx] - EEPV_start
+    max_target_location = np.stack([xgrid[ix], ygrid[iy]], axis=-1)
     return maxEPV_added, max_target_location
+
+def epv_report( events, tracking_home, tracking_away, GK_numbers, EPV, params, event_ids=None ):
+    """ epv_report
+    
+    EPV-added, raw EPV difference and maximum achievable EPV-added (with its location) of every pass, as a DataFrame indexed by event id
+    
+    """
+    if event_ids is None:
+        event_ids = events[events.Type=='PASS'].index
+    EEPV_added, EPV_difference = calculate_epv_added_for_passes(events, tracking_home, tracking_away, GK_numbers, EPV, params, event_ids)
+    maxEPV_added, max_target_location = find_max_value_added_targets(events, tracking_home, tracking_away, GK_numbers, EPV, params, event_ids)
+    return events.loc[event_ids,['Team','Start Frame']].assign(
+        EEPV_added=EEPV_added, EPV_difference=EPV_difference, maxEPV_added=maxEPV_added,
+        max_target_x=max_target_location[:,0], max_target_y=max_target_location[:,1])
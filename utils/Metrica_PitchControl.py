@@ -24,11 +24,20 @@ calculate_pitch_control_at_target(): calculate the pitch control probability for
 generate_pitch_control_for_event(): this function evaluates pitch control surface over the entire field at the moment
 of the given event (determined by the index of the event passed as an input)
 
+generate_pitch_control_for_event_vectorized(): same surface as generate_pitch_control_for_event(), with all players and grid cells
+evaluated at once (times_to_intercept() and integrate_pitch_control())
+
+pitch_control_for_frames(): pitch control surfaces for whole sequences of frames (tracking data or generated trajectories) from position arrays
+
+pitch_control_surfaces(), integrate_team_pitch_control(): pitch control surfaces / pitch control at target positions for TeamState inputs
+
 Classes
 ---------
 
 The 'player' class collects and stores trajectory information for each player required by the pitch control calculations.
 
+The 'TeamState' class holds the same information for a whole team over many frames as arrays, for the vectorized functions.
+
 @author: Laurie Shaw (@EightyFivePoint)
 
 """
@@ -342,3 +351,483 @@ def calculate_pitch_control_at_target(target_position, attacking_players, defend
 
 
     
+
+""" Vectorized pitch control """
+
+class TeamState(object):
+    """
+    TeamState() class
+    
+    Array-backed alternative to a list of 'player' objects: holds the state of all players of a team over any number of frames
+    (e.g. the start frames of a set of passes, or a predicted trajectory), so that offsides, times-to-intercept and intercept
+    probabilities are evaluated as array operations. Players that are not on the pitch have NaN positions.
+    
+    __init__ Parameters
+    -----------
+    positions: (n_frames, n_players, 2) array of player positions
+    velocities: (n_frames, n_players, 2) array of player velocities (a velocity with a NaN component is set to zero)
+    params: Dictionary of model parameters (default model parameters can be generated using default_model_params() )
+    gk_index: index of the goalkeeper in the player axis (int or (n_frames,) array). None if the team has no goalkeeper on the pitch
+    player_ids: optional (n_players,) ids (jersey numbers) of the players
+    
+    Attributes (all (n_frames, n_players) arrays)
+    -----------
+    vmax, reaction_time, tti_sigma, lambda_att, lambda_def: player parameters, as in the 'player' class
+    is_gk: goalkeeper mask
+    offside: offside mask (set by check_offsides)
+
+    methods include:
+    -----------
+    from_tracking(tracking, teamname, params, GKid, frames): build the team state directly from a tracking DataFrame
+    check_offsides(defending_team, ball_positions): flag offside players of the (attacking) team
+    time_to_intercept(target_positions): time for every player to reach every target position (inf for players not taking part)
+    probability_intercept_ball(T, time_to_intercept): probability players will have controlled the ball at time T
+    
+    """
+    _player_fields = ('positions','velocities','vmax','reaction_time','tti_sigma','lambda_att','lambda_def','is_gk','offside')
+    
+    def __init__(self, positions, velocities, params, gk_index=None, player_ids=None):
+        self.positions = np.asarray(positions, dtype=float)
+        velocities = np.broadcast_to( np.asarray(velocities, dtype=float), self.positions.shape )
+        self.velocities = np.where( np.isnan(velocities).any(-1, keepdims=True), 0., velocities ) # as player.get_velocity: NaN in either component -> [0,0]
+        n_frames, n_players = self.positions.shape[:2]
+        self.player_ids = player_ids
+        self.vmax = np.full( (n_frames,n_players), params['max_player_speed'] ) # player max speed in m/s. Could be individualised
+        self.reaction_time = np.full( (n_frames,n_players), params['reaction_time'] ) # player reaction time in 's'. Could be individualised
+        self.tti_sigma = np.full( (n_frames,n_players), params['tti_sigma'] ) # standard deviation of sigmoid function (see Eq 4 in Spearman, 2018)
+        self.is_gk = np.zeros( (n_frames,n_players), dtype=bool )
+        if gk_index is not None:
+            self.is_gk[np.arange(n_frames), gk_index] = True
+        self.lambda_att = np.full( (n_frames,n_players), params['lambda_att'] )
+        self.lambda_def = np.where( self.is_gk, params['lambda_gk'], params['lambda_def'] ) # goal keepers are quicker to control the ball
+        self.offside = np.zeros( (n_frames,n_players), dtype=bool )
+    
+    @classmethod
+    def from_tracking(cls, tracking, teamname, params, GKid, frames=None):
+        """ Team state at the given frame number(s) (DataFrame index, default: all frames) of a tracking DataFrame with velocities """
+        player_ids = np.unique( [ c.split('_')[1] for c in tracking.keys() if c[:4] == teamname ] )
+        rows = tracking if frames is None else tracking.loc[np.atleast_1d(frames)]
+        position_columns = [ "%s_%s_%s" % (teamname,p,c) for p in player_ids for c in ('x','y') ]
+        velocity_columns = [ "%s_%s_%s" % (teamname,p,c) for p in player_ids for c in ('vx','vy') ]
+        positions = rows[position_columns].to_numpy(dtype=float).reshape(len(rows),len(player_ids),2)
+        velocities = rows[velocity_columns].to_numpy(dtype=float).reshape(len(rows),len(player_ids),2)
+        gk_index = np.flatnonzero(player_ids==GKid)
+        return cls(positions, velocities, params, gk_index=gk_index[0] if gk_index.size else None, player_ids=player_ids)
+    
+    @property
+    def n_frames(self):
+        return self.positions.shape[0]
+    
+    @property
+    def n_players(self):
+        return self.positions.shape[1]
+    
+    @property
+    def inframe(self):
+        return ~np.any( np.isnan(self.positions), axis=-1 )
+    
+    @property
+    def gk_index(self):
+        return np.argmax(self.is_gk, axis=1)
+    
+    def _replace(self, **fields):
+        state = object.__new__(TeamState)
+        state.__dict__.update(self.__dict__)
+        state.__dict__.update(fields)
+        return state
+    
+    def frames(self, idx):
+        """ Team state restricted to a subset (slice, index array or mask) of the frames """
+        return self._replace( **{ f: getattr(self,f)[idx] for f in self._player_fields } )
+    
+    def pad_players(self, n_players):
+        """ Team state padded with absent (NaN) players up to n_players """
+        pad = n_players-self.n_players
+        if pad <= 0:
+            return self
+        fields = {}
+        for f in self._player_fields:
+            a = getattr(self,f)
+            if f == 'positions':
+                fields[f] = np.pad(a, ((0,0),(0,pad),(0,0)), constant_values=np.nan)
+            elif a.dtype == bool or a.ndim == 3:
+                fields[f] = np.pad(a, ((0,0),(0,pad))+((0,0),)*(a.ndim-2))
+            else:
+                fields[f] = np.pad(a, ((0,0),(0,pad)), mode='edge')
+        return self._replace(**fields)
+    
+    @staticmethod
+    def where(condition, team_a, team_b):
+        """ Frame-wise selection between two team states: team_a where condition (n_frames,) is True, team_b otherwise """
+        n_players = max(team_a.n_players, team_b.n_players)
+        team_a, team_b = team_a.pad_players(n_players), team_b.pad_players(n_players)
+        condition = np.asarray(condition, dtype=bool)
+        fields = {}
+        for f in TeamState._player_fields:
+            a = getattr(team_a,f)
+            fields[f] = np.where( condition.reshape((-1,)+(1,)*(a.ndim-1)), a, getattr(team_b,f) )
+        return team_a._replace(player_ids=None, **fields)
+    
+    def check_offsides(self, defending_team, ball_positions, verbose=False, tol=0.2):
+        """ Flags attacking players that are offside (see check_offsides) and returns the team state """
+        # make sure the defending goalkeeper is actually on the field in every frame!
+        frames = np.arange(defending_team.n_frames)
+        gk_on_pitch = defending_team.is_gk.any(axis=1) & defending_team.inframe[frames, defending_team.gk_index]
+        assert gk_on_pitch.all(), "Defending goalkeeper not on the pitch (frame indices %s)" % np.flatnonzero(~gk_on_pitch)
+        self.offside = offside_mask(self.positions, defending_team.positions, ball_positions, defending_team.gk_index, tol=tol)
+        if verbose:
+            for f, p in zip(*np.nonzero(self.offside)):
+                print("player %s is offside in frame %d" % (p if self.player_ids is None else self.player_ids[p], f) )
+        return self
+    
+    def time_to_intercept(self, target_positions):
+        """ (n_frames, n_targets, n_players) times to intercept of target_positions ((n_targets,2) or (n_frames,n_targets,2)); inf for absent or offside players """
+        tti = times_to_intercept(target_positions, self.positions, self.velocities, self.reaction_time, self.vmax)
+        excluded = ~self.inframe | self.offside
+        return np.where( np.isnan(tti) | excluded[:,None,:], np.inf, tti )
+    
+    def probability_intercept_ball(self, T, time_to_intercept):
+        """ Probability of each player having controlled the ball at time T, given (n_frames, n_targets, n_players) times to intercept """
+        return intercept_probability(T, time_to_intercept, self.tti_sigma[:,None,:])
+
+def times_to_intercept(target_positions, positions, velocities, reaction_time, vmax):
+    """ times_to_intercept
+    
+    Vectorized player.simple_time_to_intercept: time for every player to reach every target position
+    
+    Parameters
+    -----------
+        target_positions: (..., n_targets, 2) array of target positions
+        positions, velocities: (..., n_players, 2) arrays of player positions and velocities (NaN velocities should already be set to zero)
+        reaction_time, vmax: (..., n_players) arrays or scalars of player reaction times and maximum speeds
+        
+    Returns
+    -----------
+        tti: (..., n_targets, n_players) array of times to intercept
+    """
+    reaction_time = np.broadcast_to( np.asarray(reaction_time, dtype=float), positions.shape[:-1] )
+    vmax = np.broadcast_to( np.asarray(vmax, dtype=float), positions.shape[:-1] )
+    r_reaction = positions + velocities*reaction_time[...,None]
+    distance = np.linalg.norm( target_positions[...,:,None,:] - r_reaction[...,None,:,:], axis=-1 )
+    return reaction_time[...,None,:] + distance/vmax[...,None,:]
+
+def intercept_probability(T, time_to_intercept, tti_sigma):
+    """ Vectorized player.probability_intercept_ball: probability of arriving at the target at time 'T' given the expected time of arrival (Spearman 2018) """
+    return 1/(1. + np.exp( -np.pi/np.sqrt(3.0)/tti_sigma * (T-time_to_intercept) ) )
+
+def _pack_players(tti, *player_params):
+    """ Moves the players that take part (finite time to intercept) to the first columns of every row and drops the columns no row needs """
+    taking_part = np.isfinite(tti)
+    order = np.argsort(~taking_part, axis=1, kind='stable')[:,:max(taking_part.sum(axis=1).max(),1)]
+    return tuple( np.take_along_axis(a, order, axis=1) for a in (tti,)+player_params )
+
+def integrate_pitch_control(tti_att, tti_def, ball_travel_time, params, lambda_att=None, lambda_def=None, tti_sigma_att=None, tti_sigma_def=None):
+    """ integrate_pitch_control
+    
+    Vectorized calculate_pitch_control_at_target: solves equation 3 of Spearman 2018 for many target cells at once. Every cell follows the
+    same steps as the per-cell function (head-start short cuts, removal of players far in time, integration until convergence),
+    but all cells still being integrated are advanced together at each timestep.
+    
+    Parameters
+    -----------
+        tti_att: (n_cells, n_att) times to intercept of the attacking players. Use np.inf for players that do not take part (e.g. offside or padding)
+        tti_def: (n_cells, n_def) times to intercept of the defending players
+        ball_travel_time: (n_cells,) ball travel time to each cell
+        params: Dictionary of model parameters (default model parameters can be generated using default_model_params() )
+        lambda_att, lambda_def: ball control parameter per player, broadcastable to tti_att / tti_def. Defaults to params['lambda_att'] / params['lambda_def']
+        tti_sigma_att, tti_sigma_def: arrival time uncertainty per player, broadcastable to tti_att / tti_def. Defaults to params['tti_sigma']
+        
+    Returns
+    -----------
+        PPCFatt: (n_cells,) pitch control probability for the attacking team
+        PPCFdef: (n_cells,) pitch control probability for the defending team
+    """
+    tti_att = np.asarray(tti_att, dtype=float)
+    tti_def = np.asarray(tti_def, dtype=float)
+    ball_travel_time = np.broadcast_to( np.asarray(ball_travel_time, dtype=float), tti_att.shape[:1] )
+    lambda_att = np.broadcast_to( params['lambda_att'] if lambda_att is None else lambda_att, tti_att.shape )
+    lambda_def = np.broadcast_to( params['lambda_def'] if lambda_def is None else lambda_def, tti_def.shape )
+    sigma_att = np.broadcast_to( params['tti_sigma'] if tti_sigma_att is None else tti_sigma_att, tti_att.shape )
+    sigma_def = np.broadcast_to( params['tti_sigma'] if tti_sigma_def is None else tti_sigma_def, tti_def.shape )
+    
+    n_cells = tti_att.shape[0]
+    PPCFatt = np.zeros(n_cells)
+    PPCFdef = np.zeros(n_cells)
+    # arrival time of 'nearest' attacking and defending player
+    tau_min_att = np.nanmin( tti_att, axis=1 )
+    tau_min_def = np.nanmin( tti_def, axis=1 )
+    # cells where one team arrives significantly before the other: no need to solve the pitch control model
+    def_first = tau_min_att-np.maximum(ball_travel_time,tau_min_def) >= params['time_to_control_def']
+    att_first = ~def_first & ( tau_min_def-np.maximum(ball_travel_time,tau_min_att) >= params['time_to_control_att'] )
+    PPCFdef[def_first] = 1.
+    PPCFatt[att_first] = 1.
+    
+    cells = np.flatnonzero( ~def_first & ~att_first )
+    if cells.size == 0:
+        return PPCFatt, PPCFdef
+    # remove any player that is far (in time) from the target location
+    tta = np.where( tti_att[cells]-tau_min_att[cells,None] < params['time_to_control_att'], tti_att[cells], np.inf )
+    ttd = np.where( tti_def[cells]-tau_min_def[cells,None] < params['time_to_control_def'], tti_def[cells], np.inf )
+    # only keep as many player columns as the cell with the most remaining players needs
+    tta, sigma_att, lam_att = _pack_players(tta, sigma_att[cells], lambda_att[cells])
+    ttd, sigma_def, lam_def = _pack_players(ttd, sigma_def[cells], lambda_def[cells])
+    # integration timesteps, identical to np.arange(ball_travel_time-int_dt, ball_travel_time+max_int_time, int_dt) of each cell
+    dt = params['int_dt']
+    T0 = ball_travel_time[cells]-dt
+    dT = (T0+dt)-T0
+    n_steps = np.ceil( (ball_travel_time[cells]+params['max_int_time']-T0)/dt ).astype(int)
+    
+    ptot_att = np.zeros(cells.size)
+    ptot_def = np.zeros(cells.size)
+    # working arrays hold the cells still being integrated. Finished cells are recorded straight away but only
+    # dropped from the working arrays once enough of them have accumulated (compacting every step costs more than it saves)
+    active = np.flatnonzero( n_steps > 1 )
+    work = [a[active] for a in (T0, dT, n_steps, tta, ttd, sigma_att, sigma_def, lam_att, lam_def)]
+    player_att = np.zeros_like(work[3]) # individual player contributions
+    player_def = np.zeros_like(work[4])
+    sum_att = np.zeros(active.size)
+    sum_def = np.zeros(active.size)
+    alive = np.ones(active.size, dtype=bool)
+    n_alive = active.size
+    i = 1
+    with np.errstate(over='ignore'):
+        while n_alive:
+            T0_w, dT_w, n_steps_w, tta_w, ttd_w, sigma_att_w, sigma_def_w, lam_att_w, lam_def_w = work
+            T = (T0_w + i*dT_w)[:,None]
+            remaining = np.where( alive, 1-sum_att-sum_def, 0. )[:,None] # finished cells are frozen
+            # ball control probability for each player in time interval T+dt
+            dPPCFdT_att = remaining*intercept_probability(T, tta_w, sigma_att_w)*lam_att_w
+            dPPCFdT_def = remaining*intercept_probability(T, ttd_w, sigma_def_w)*lam_def_w
+            assert np.all(dPPCFdT_att>=0) and np.all(dPPCFdT_def>=0), 'Invalid player probability (integrate_pitch_control)'
+            player_att += dPPCFdT_att*dt
+            player_def += dPPCFdT_def*dt
+            sum_att = player_att.sum(axis=1)
+            sum_def = player_def.sum(axis=1)
+            i += 1
+            ptot = sum_att+sum_def
+            running = 1-ptot>params['model_converge_tol']
+            finished = alive & ~( running & (i<n_steps_w) )
+            if not finished.any():
+                continue
+            failed = finished & running
+            if np.any(failed):
+                print("Integration failed to converge in %d cells: min %1.3f" % (failed.sum(), ptot[failed].min()) )
+            ptot_att[active[finished]] = sum_att[finished]
+            ptot_def[active[finished]] = sum_def[finished]
+            alive &= ~finished
+            n_alive = alive.sum()
+            if n_alive < 0.75*alive.size:
+                active = active[alive]
+                work = [a[alive] for a in work]
+                player_att, player_def, sum_att, sum_def = player_att[alive], player_def[alive], sum_att[alive], sum_def[alive]
+                alive = alive[alive]
+    PPCFatt[cells] = ptot_att
+    PPCFdef[cells] = ptot_def
+    return PPCFatt, PPCFdef
+
+def pitch_control_grid(field_dimen = (106.,68.,), n_grid_cells_x = 50):
+    """ pitch_control_grid
+    
+    Cell centres of the pitch control grid used by generate_pitch_control_for_event
+    
+    Returns
+    -----------
+        xgrid, ygrid: Positions of the pixels in the x-direction (field length) and y-direction (field width)
+        targets: (n_grid_cells_y*n_grid_cells_x, 2) array of cell centres in row-major (y, x) order
+    """
+    n_grid_cells_y = int(n_grid_cells_x*field_dimen[1]/field_dimen[0])
+    dx = field_dimen[0]/n_grid_cells_x
+    dy = field_dimen[1]/n_grid_cells_y
+    xgrid = np.arange(n_grid_cells_x)*dx - field_dimen[0]/2. + dx/2.
+    ygrid = np.arange(n_grid_cells_y)*dy - field_dimen[1]/2. + dy/2.
+    gx, gy = np.meshgrid(xgrid, ygrid)
+    targets = np.stack([gx.ravel(), gy.ravel()], axis=-1)
+    return xgrid, ygrid, targets
+
+def ball_travel_times(target_positions, ball_start_pos, params):
+    """ Ball travel time from ball_start_pos (..., 2) to target_positions (..., n_targets, 2); zero where the ball position is NaN (ball already at the target) """
+    if ball_start_pos is None:
+        return np.zeros(target_positions.shape[:-1])
+    ball_start_pos = np.asarray(ball_start_pos, dtype=float)
+    travel = np.linalg.norm( target_positions - ball_start_pos[...,None,:], axis=-1 )/params['average_ball_speed']
+    return np.where( np.isnan(travel), 0.0, travel )
+
+def generate_pitch_control_for_event_vectorized(event_id, events, tracking_home, tracking_away, params, GK_numbers, field_dimen = (106.,68.,), n_grid_cells_x = 50, offsides=True):
+    """ generate_pitch_control_for_event_vectorized
+    
+    Same inputs and outputs as generate_pitch_control_for_event, but the times-to-intercept of all players to all cells are computed at once
+    and the control equation is integrated for all cells in parallel (integrate_pitch_control).
+    
+    Returns
+    -----------
+        PPCFa: Pitch control surface (dimen (n_grid_cells_y,n_grid_cells_x) ) containing pitch control probability for the attcking team.
+        xgrid: Positions of the pixels in the x-direction (field length)
+        ygrid: Positions of the pixels in the y-direction (field width)
+    """
+    pass_frame = events.loc[event_id]['Start Frame']
+    pass_team = events.loc[event_id].Team
+    ball_start_pos = np.array([events.loc[event_id]['Start X'],events.loc[event_id]['Start Y']])
+    xgrid, ygrid, targets = pitch_control_grid(field_dimen, n_grid_cells_x)
+    home = TeamState.from_tracking(tracking_home,'Home',params,GK_numbers[0],pass_frame)
+    away = TeamState.from_tracking(tracking_away,'Away',params,GK_numbers[1],pass_frame)
+    if pass_team=='Home':
+        attacking_team, defending_team = home, away
+    elif pass_team=='Away':
+        attacking_team, defending_team = away, home
+    else:
+        assert False, "Team in possession must be either home or away"
+    if offsides:
+        assert defending_team.is_gk.any(), "Defending goalkeeper jersey number not found in defending players"
+        attacking_team.check_offsides(defending_team, ball_start_pos[None,:])
+    
+    PPCFa, PPCFd = integrate_team_pitch_control(targets, attacking_team, defending_team, ball_start_pos[None,:], params)
+    PPCFa = PPCFa.reshape(len(ygrid), len(xgrid))
+    PPCFd = PPCFd.reshape(len(ygrid), len(xgrid))
+    # check probabilitiy sums within convergence
+    checksum = np.sum( PPCFa + PPCFd ) / float(PPCFa.size)
+    assert 1-checksum < params['model_converge_tol'], "Checksum failed: %1.3f" % (1-checksum)
+    return PPCFa,xgrid,ygrid
+
+def finite_difference_velocities(positions, framerate=25):
+    """ Player velocities (m/s) from a (..., n_frames, n_players, 2) array of positions, using central differences along the frame axis """
+    positions = np.asarray(positions, dtype=float)
+    if positions.shape[-3] < 2:
+        return np.zeros_like(positions)
+    return np.gradient(positions, axis=-3) * framerate
+
+def offside_mask(attacking_positions, defending_positions, ball_positions, defending_GK, tol=0.2):
+    """ offside_mask
+    
+    Vectorized check_offsides for many frames at once. Absent (NaN) players are never offside and are ignored when finding the offside line.
+    
+    Parameters
+    -----------
+        attacking_positions, defending_positions: (n_frames, n_players, 2) arrays of player positions
+        ball_positions: (n_frames, 2) array of ball positions (NaN or None: the ball position is ignored)
+        defending_GK: (n_frames,) index of the defending goalkeeper in defending_positions (just to establish attack direction)
+        tol: A tolerance parameter that allows a player to be very marginally offside (up to 'tol' m) without being flagged offside. Default: 0.2m
+        
+    Returns
+    -----------
+        offside: (n_frames, n_att) boolean array, True for attacking players that are offside
+    """
+    frames = np.arange(defending_positions.shape[0])
+    # use defending goalkeeper x position to figure out which half he is defending (-1: left goal, +1: right goal)
+    defending_half = np.sign( defending_positions[frames,defending_GK,0] )
+    # x-position of the second-deepest defending player (including GK)
+    depth = np.where( np.isnan(defending_positions[...,0]), -np.inf, defending_half[:,None]*defending_positions[...,0] )
+    second_deepest_defender_x = -np.sort( -depth, axis=1 )[:,1]
+    ball_x = np.full(frames.size, np.nan) if ball_positions is None else defending_half*ball_positions[:,0]
+    # offside line is the maximum of second_deepest_defender_x, ball position and half-way line
+    offside_line = np.fmax( np.fmax(second_deepest_defender_x, ball_x), 0.0 ) + tol
+    with np.errstate(invalid='ignore'):
+        return attacking_positions[...,0]*defending_half[:,None] > offside_line[:,None]
+
+def integrate_team_pitch_control(target_positions, attacking_team, defending_team, ball_positions, params):
+    """ integrate_team_pitch_control
+    
+    Pitch control at any set of target positions for every frame of a pair of team states (offside attacking players should already be flagged)
+    
+    Parameters
+    -----------
+        target_positions: (n_targets, 2) or (n_frames, n_targets, 2) array of target positions
+        attacking_team, defending_team: TeamState of the attacking and defending team
+        ball_positions: (n_frames, 2) ball positions (start position of a pass), or None
+        params: Dictionary of model parameters (default model parameters can be generated using default_model_params() )
+        
+    Returns
+    -----------
+        PPCFatt: (n_frames, n_targets) pitch control probability for the attacking team
+        PPCFdef: (n_frames, n_targets) pitch control probability for the defending team
+    """
+    n_frames = attacking_team.n_frames
+    tti_att = attacking_team.time_to_intercept(target_positions)
+    tti_def = defending_team.time_to_intercept(target_positions)
+    n_targets = tti_att.shape[1]
+    ball_travel_time = np.broadcast_to( ball_travel_times(target_positions, ball_positions, params), (n_frames, n_targets) )
+    # player parameters are the same for every target of a frame
+    player_param = lambda a: np.broadcast_to( a[:,None,:], (n_frames, n_targets, a.shape[1]) ).reshape(n_frames*n_targets, -1)
+    PPCFatt, PPCFdef = integrate_pitch_control(tti_att.reshape(n_frames*n_targets,-1), tti_def.reshape(n_frames*n_targets,-1), ball_travel_time.reshape(-1), params,
+                                               lambda_att=player_param(attacking_team.lambda_att), lambda_def=player_param(defending_team.lambda_def),
+                                               tti_sigma_att=player_param(attacking_team.tti_sigma), tti_sigma_def=player_param(defending_team.tti_sigma))
+    return PPCFatt.reshape(n_frames, n_targets), PPCFdef.reshape(n_frames, n_targets)
+
+def pitch_control_for_frames(attacking_positions, defending_positions, ball_positions, params, attacking_velocities=None, defending_velocities=None,
+                             defending_GK=None, framerate=25, offsides=True, field_dimen = (106.,68.,), n_grid_cells_x = 50, chunk_size=32):
+    """ pitch_control_for_frames
+    
+    Pitch control surfaces for whole sequences of frames in one call, from arrays of positions rather than tracking DataFrames.
+    Works for real tracking data as well as generated trajectories (e.g. (n_samples, n_frames, n_players, 2) predictions).
+    
+    Parameters
+    -----------
+        attacking_positions: (..., n_frames, n_att, 2) positions (m) of the attacking team. NaN positions are treated as players not on the pitch.
+        defending_positions: (..., n_frames, n_def, 2) positions (m) of the defending team
+        ball_positions: (..., n_frames, 2) ball positions (start position of a pass). None or NaN: the ball is assumed to be at the target position
+        params: Dictionary of model parameters (default model parameters can be generated using default_model_params() )
+        attacking_velocities, defending_velocities: arrays shaped like the positions (m/s). If None, calculated with finite_difference_velocities()
+        defending_GK: index of the defending goalkeeper in defending_positions (int or (..., n_frames) array). If None, the defender furthest from the halfway line
+        framerate: frames per second, used to calculate velocities
+        offsides: If True, find and remove offside attacking players from the calculation
+        field_dimen: tuple containing the length and width of the pitch in meters. Default is (106,68)
+        n_grid_cells_x: Number of pixels in the grid (in the x-direction) that covers the surface. Default is 50.
+        chunk_size: number of frames evaluated together (bounds memory use)
+        
+    Returns
+    -----------
+        PPCFa: (..., n_frames, n_grid_cells_y, n_grid_cells_x) pitch control surfaces for the attacking team
+        xgrid: Positions of the pixels in the x-direction (field length)
+        ygrid: Positions of the pixels in the y-direction (field width)
+    """
+    attacking_positions = np.asarray(attacking_positions, dtype=float)
+    defending_positions = np.asarray(defending_positions, dtype=float)
+    if attacking_velocities is None:
+        attacking_velocities = finite_difference_velocities(attacking_positions, framerate)
+    if defending_velocities is None:
+        defending_velocities = finite_difference_velocities(defending_positions, framerate)
+    lead_shape = attacking_positions.shape[:-2]
+    n_att, n_def = attacking_positions.shape[-2], defending_positions.shape[-2]
+    
+    # flatten all leading dimensions to a single frame axis
+    def_pos = defending_positions.reshape(-1,n_def,2)
+    ball_pos = None if ball_positions is None else np.broadcast_to( np.asarray(ball_positions, dtype=float), lead_shape+(2,) ).reshape(-1,2)
+    if defending_GK is None:
+        defending_GK = np.argmax( np.where(np.isnan(def_pos[...,0]), -np.inf, np.abs(def_pos[...,0])), axis=1 )
+    else:
+        defending_GK = np.broadcast_to(defending_GK, lead_shape).reshape(-1)
+    attacking_team = TeamState(attacking_positions.reshape(-1,n_att,2), np.broadcast_to(attacking_velocities, attacking_positions.shape).reshape(-1,n_att,2), params)
+    defending_team = TeamState(def_pos, np.broadcast_to(defending_velocities, defending_positions.shape).reshape(-1,n_def,2), params, gk_index=defending_GK)
+    if offsides:
+        attacking_team.check_offsides(defending_team, ball_pos)
+    
+    PPCFa, xgrid, ygrid = pitch_control_surfaces(attacking_team, defending_team, ball_pos, params, field_dimen, n_grid_cells_x, chunk_size)
+    return PPCFa.reshape(lead_shape+PPCFa.shape[1:]), xgrid, ygrid
+
+def pitch_control_surfaces(attacking_team, defending_team, ball_positions, params, field_dimen = (106.,68.,), n_grid_cells_x = 50, chunk_size=32):
+    """ pitch_control_surfaces
+    
+    Attacking team pitch control surfaces for every frame of a pair of team states (offside attacking players should already be flagged)
+    
+    Parameters
+    -----------
+        attacking_team, defending_team: TeamState of the attacking and defending team
+        ball_positions: (n_frames, 2) ball positions (start position of a pass), or None
+        params: Dictionary of model parameters (default model parameters can be generated using default_model_params() )
+        field_dimen: tuple containing the length and width of the pitch in meters. Default is (106,68)
+        n_grid_cells_x: Number of pixels in the grid (in the x-direction) that covers the surface. Default is 50.
+        chunk_size: number of frames evaluated together (bounds memory use)
+        
+    Returns
+    -----------
+        PPCFa: (n_frames, n_grid_cells_y, n_grid_cells_x) pitch control surfaces for the attacking team
+        xgrid: Positions of the pixels in the x-direction (field length)
+        ygrid: Positions of the pixels in the y-direction (field width)
+    """
+    xgrid, ygrid, targets = pitch_control_grid(field_dimen, n_grid_cells_x)
+    n_frames = attacking_team.n_frames
+    PPCFa = np.zeros((n_frames, targets.shape[0]))
+    for start in range(0, n_frames, chunk_size):
+        f = slice(start, start+chunk_size)
+        PPCFa[f], _ = integrate_team_pitch_control(targets, attacking_team.frames(f), defending_team.frames(f),
+                                                   None if ball_positions is None else ball_positions[f], params)
+    return PPCFa.reshape(n_frames, len(ygrid), len(xgrid)), xgrid, ygrid
@@ -0,0 +1,118 @@
+import heapq
+import itertools
+import multiprocessing as mp
+
+import matplotlib
+
+# Trajectory plots rendered in a background process pool, off the inference loop.
+# Each worker draws the pitch once and reuses it (with a precomputed tight bbox) for every plot.
+
+_figax = None
+_bbox = None
+
+
+def _init_worker():
+    global _figax, _bbox
+    matplotlib.use("Agg")
+    from utils.utils import plot_pitch
+
+    fig, ax = plot_pitch(field_dimen=(105.0, 68.0), field_color='green')
+    fig.canvas.draw()
+    # same box as bbox_inches='tight' (pad_inches=0.1); trajectories are clipped to the axes
+    _bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.1)
+    _figax = (fig, ax)
+
+
+def _render(others, target, pred, kwargs):
+    from utils.utils import plot_trajectories_on_pitch
+
+    plot_trajectories_on_pitch(others, target, pred, figax=_figax, bbox_inches=_bbox, **kwargs)
+    return kwargs.get('save_path')
+
+
+# Worker loop: render tasks until None, report each save_path (or the exception raised)
+def _worker(tasks, results):
+    _init_worker()
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        try:
+            results.put(_render(*task))
+        except Exception as e:
+            results.put(e)
+
+
+# Workers are forked (the scripts have no __main__ guard for spawn / forkserver) in __init__: create the plotter
+# before any DataLoader, prefetch or checkpoint thread exists, since forking while another thread holds a lock
+# (allocator, logging, tqdm) can deadlock the workers. Tasks / results go over SimpleQueue pipes, so unlike a
+# ProcessPoolExecutor / Pool / Queue the plotter starts no helper threads of its own in the calling process,
+# and later forks (DataLoader workers) stay safe.
+class AsyncPlotter:
+    def __init__(self, num_workers=4):
+        ctx = mp.get_context("fork")
+        self.tasks = ctx.SimpleQueue()
+        self.results = ctx.SimpleQueue()
+        self.workers = [ctx.Process(target=_worker, args=(self.tasks, self.results), daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.pending = 0
+        self.errors = []
+
+    def _collect(self, block=False):
+        while self.pending and (block or not self.results.empty()):
+            result = self.results.get()
+            self.pending -= 1
+            if isinstance(result, Exception):
+                self.errors.append(result)
+
+    # others / target / pred: numpy arrays, kwargs: plot_trajectories_on_pitch options incl. save_path.
+    # Blocks while the task pipe is full (back-pressure instead of an unbounded queue).
+    def submit(self, others, target, pred, **kwargs):
+        self._collect()
+        self.tasks.put((others, target, pred, kwargs))
+        self.pending += 1
+
+    # Waits for all submitted plots and re-raises the first worker error
+    def close(self, wait=True):
+        if wait:
+            self._collect(block=True)
+            for _ in self.workers:
+                self.tasks.put(None)
+        for worker in self.workers:
+            if wait:
+                worker.join()
+            else:
+                worker.terminate()
+        self.workers = []
+        if self.errors:
+            raise self.errors[0]
+
+
+# Keeps only the k lowest and k highest scoring plots (e.g. by ADE) seen over the whole test set
+class TopBottomK:
+    def __init__(self, k=16):
+        self.k = k
+        self.best = []   # max-heap on score via (-score, ...)
+        self.worst = []  # min-heap on score
+        self.counter = itertools.count()
+
+    def add(self, score, payload):
+        n = next(self.counter)
+        item = (-score, n, payload)
+        if len(self.best) < self.k:
+            heapq.heappush(self.best, item)
+        elif item > self.best[0]:
+            heapq.heapreplace(self.best, item)
+
+        item = (score, n, payload)
+        if len(self.worst) < self.k:
+            heapq.heappush(self.worst, item)
+        elif item > self.worst[0]:
+            heapq.heapreplace(self.worst, item)
+
+    # [(score, payload)] sorted best-first / worst-first
+    def results(self):
+        best = [(-s, p) for s, _, p in sorted(self.best, reverse=True)]
+        worst = [(s, p) for s, _, p in sorted(self.worst, reverse=True)]
+        return best, worst
@@ -5,9 +5,14 @@ import pandas as pd
 from tqdm import tqdm
 from collections import defaultdict
 import random
+import functools
+import queue
+import threading
+import torch
 from torch.utils.data import DataLoader, Subset
 from torch.utils.data._utils.collate import default_collate
-from torch_geometric.data import Batch as GeoBatch
+from torch_geometric.data import Batch as GeoBatch, HeteroData
+from utils.graph_utils import DenseGraph
 
 # Return related feature columns for given x/y columns
 def get_related_features(columns, all_cols):
@@ -235,12 +240,27 @@ def compute_train_zscore_stats(dataset, train_indices, save_path="train_zscore_s
     return stats
 
 
+# Positions of the target players' x / y columns in the condition layout, computed once per layout
+@functools.lru_cache(maxsize=None)
+def target_condition_indices(target_columns, condition_columns):
+    column_index = {c: i for i, c in enumerate(condition_columns)}
+    x_indices, y_indices = [], []
+    for x_col, y_col in zip(target_columns[0::2], target_columns[1::2]):
+        if x_col in column_index and y_col in column_index:
+            x_indices.append(column_index[x_col])
+            y_indices.append(column_index[y_col])
+    return x_indices, y_indices
+
+
 # Custom collate function to batch
 def custom_collate_fn(batch):
     collated = {}
     for key in batch[0]:
         if key in ("other_columns", "target_columns", "condition_columns"):
             collated[key] = [b[key] for b in batch]
+        elif key == "graph" and isinstance(batch[0]["graph"], DenseGraph):
+            collated[key] = DenseGraph(*(default_collate(list(f)) if f[0] is not None else None
+                                         for f in zip(*(b["graph"] for b in batch))))
         elif key == "graph":
             collated[key] = GeoBatch.from_data_list([b["graph"] for b in batch])
         elif key == "pitch_scale":
@@ -254,3 +274,123 @@ def custom_collate_fn(batch):
 
 
 
+
+
+# Moves every tensor / graph (HeteroData batch, DenseGraph) of a collated batch to device
+def batch_to_device(batch, device, non_blocking=False):
+    return {k: v.to(device, non_blocking=non_blocking) if isinstance(v, (torch.Tensor, DenseGraph, HeteroData)) else v
+            for k, v in batch.items()}
+
+
+# Wraps a DataLoader and yields batches already on device, the next one transferred while the current step runs.
+# CUDA: copies on a side stream (use pin_memory=True for truly async copies), the compute stream waits for them.
+# Otherwise: a background thread loads (and moves) up to `prefetch` batches ahead.
+class DevicePrefetcher:
+    def __init__(self, loader, device, prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.prefetch = prefetch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == "cuda":
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(self.device)
+
+        def load(it):
+            batch = next(it, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return batch_to_device(batch, self.device, non_blocking=True)
+
+        it = iter(self.loader)
+        next_batch = load(it)
+        while next_batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = next_batch
+            # memory allocated on the side stream is used by the compute stream from now on
+            for v in batch.values():
+                if isinstance(v, DenseGraph):
+                    for t in v:
+                        if t is not None:
+                            t.record_stream(current)
+                elif isinstance(v, (torch.Tensor, HeteroData)):
+                    v.record_stream(current)
+
+            next_batch = load(it)
+            yield batch
+
+    def _iter_thread(self):
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    if not put(batch_to_device(batch, self.device)):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+# Fixed, seeded validation set: `num_samples` val samples (None: all) are loaded and collated once and kept in host
+# memory with a per-sample timestep "t" and "noise", so every validation pass scores the same (sample, t, noise)
+# triples without reloading data or rebuilding graphs. t / noise only depend on the sample, not on the batching.
+# Under DDP each rank keeps every world_size-th sample. Iterates like a DataLoader (wrap in DevicePrefetcher).
+class FixedValidationSet:
+    KEYS = ("target", "target_relative", "graph")
+
+    def __init__(self, dataset, num_steps, num_samples=None, seed=42, rank=0, world_size=1, **loader_kwargs):
+        indices = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(seed)).tolist()
+        indices = sorted(indices[:num_samples])[rank::world_size]
+
+        loader = DataLoader(Subset(dataset, indices), shuffle=False, **loader_kwargs)
+        self.batches = []
+        offset = 0
+        for batch in tqdm(loader, desc="Caching validation set", leave=False, disable=rank != 0):
+            B, T, D = batch["target_relative"].shape
+            t, noise = [], []
+            for idx in indices[offset:offset + B]:
+                g = torch.Generator().manual_seed(seed + idx)
+                t.append(torch.randint(0, num_steps, (1,), generator=g))
+                noise.append(torch.randn(T, D // 2, 2, generator=g))
+            offset += B
+            self.batches.append({**{k: batch[k] for k in self.KEYS}, "t": torch.cat(t), "noise": torch.stack(noise)})
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import uuid
+
+import torch
+
+# Graph encoder outputs H cached per dataset sample ("sample_idx"), so a frozen encoder runs once per sample
+# across sampler sweeps (ddim_step / eta / num_samples), denoiser checkpoints sharing the encoder, and epochs.
+# The store key hashes the encoder weights plus everything else that changes H (zscore stats, amp dtype, ...).
+# Only valid for an encoder in eval mode (no dropout).
+# root=None: in memory only. Otherwise entries are shared across runs / processes via root/<key>/*.pt,
+# every flush() writes its new entries to a separate file (atomically).
+
+
+def encoder_key(graph_encoder, *extra):
+    h = hashlib.sha1()
+    for name, t in sorted(graph_encoder.state_dict().items()):
+        h.update(name.encode())
+        h.update(t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    h.update(repr(extra).encode())
+    return h.hexdigest()[:16]
+
+
+class EmbeddingStore:
+    def __init__(self, key, root=None):
+        self.key = key
+        self.dir = os.path.join(root, key) if root is not None else None
+        self.cache = {}    # sample_idx -> H [C] (cpu)
+        self.pending = {}  # not yet flushed to self.dir
+        if self.dir is not None and os.path.isdir(self.dir):
+            for name in sorted(os.listdir(self.dir)):
+                if name.endswith(".pt"):
+                    part = torch.load(os.path.join(self.dir, name))
+                    self.cache.update(zip(part['sample_idx'].tolist(), part['H']))
+
+    def __len__(self):
+        return len(self.cache)
+
+    def contains_all(self, sample_idx):
+        return all(int(i) in self.cache for i in sample_idx)
+
+    # sample_idx [B] -> H [B, C] on device; encode_fn() -> H is only called if a sample is missing
+    def lookup(self, sample_idx, encode_fn, device):
+        idx = [int(i) for i in sample_idx]
+        if all(i in self.cache for i in idx):
+            return torch.stack([self.cache[i] for i in idx]).to(device, non_blocking=True)
+
+        H = encode_fn()
+        for i, h in zip(idx, H.detach().cpu()):
+            self.cache[i] = h
+            if self.dir is not None:
+                self.pending[i] = h
+        return H
+
+    def flush(self):
+        if self.dir is None or not self.pending:
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        idx = list(self.pending)
+        path = os.path.join(self.dir, f"{uuid.uuid4().hex}.pt")
+        tmp_path = path + ".tmp"
+        torch.save({'sample_idx': torch.tensor(idx), 'H': torch.stack([self.pending[i] for i in idx])}, tmp_path)
+        os.replace(tmp_path, path)
+        self.pending = {}
@@ -4,6 +4,16 @@ from torch_geometric.data import HeteroData
 import os
 import math
 from tqdm import tqdm
+from typing import NamedTuple, Optional
+
+# (source node type, destination node type, relation), node types: 0=Attk, 1=Def, 2=Ball
+SPATIAL_RELATIONS = [
+    (0, 0, "attk_and_attk"),
+    (0, 1, "attk_and_def"),
+    (1, 1, "def_and_def"),
+    (0, 2, "attk_and_ball"),
+    (1, 2, "def_and_ball"),
+]
 
 
 def frame_tensor_to_df(frame_tensor, column_names):
@@ -82,15 +92,16 @@ def extract_node_features(condition_tensor, condition_columns):
 
     return {"Node": torch.stack(unified_feats)}
 
-# Edge
-def build_edges_based_on_interactions(node_features, zscore_stats=None):
-    edge_index_dict, edge_attr_dict = {}, {}
-    nodes = node_features["Node"]        # (N, F)
-    node_type = nodes[:, -1]             # 0=Attk, 1=Def, 2=Ball
-    poss_dur = nodes[:, 7]
-    neighbor_count = nodes[:, 8]         # (N,)
-    masks = {t: (node_type == t) for t in (0, 1, 2)}
-    
+# Edge weights / connection mask of one relation, nodes: (..., N, F) -> (Ns, Nd) / (..., Ns, Nd)
+def relation_weights(nodes, s_t, d_t, rel, zscore_stats=None):
+    node_type = nodes.reshape(-1, *nodes.shape[-2:])[0, :, -1]   # 0=Attk, 1=Def, 2=Ball (same in every frame)
+    poss_dur = nodes[..., 7]
+    neighbor_count = nodes[..., 8]       # (..., N)
+    s_idx = torch.where(node_type == s_t)[0]    # (Ns,)
+    d_idx = torch.where(node_type == d_t)[0]    # (Nd,)
+    if s_idx.numel() == 0 or d_idx.numel() == 0:
+        return s_idx, d_idx, None, None
+
     def denormalize_positions(normalized_pos, node_type):
         if zscore_stats is not None:
             if node_type == 2:
@@ -99,9 +110,9 @@ def build_edges_based_on_interactions(node_features, zscore_stats=None):
             else:
                 x_mean, x_std = zscore_stats['player_x_mean'], zscore_stats['player_x_std']
                 y_mean, y_std = zscore_stats['player_y_mean'], zscore_stats['player_y_std']
-            x_real = normalized_pos[:, 0] * x_std + x_mean
-            y_real = normalized_pos[:, 1] * y_std + y_mean
-            return torch.stack([x_real, y_real], dim=1)
+            x_real = normalized_pos[..., 0] * x_std + x_mean
+            y_real = normalized_pos[..., 1] * y_std + y_mean
+            return torch.stack([x_real, y_real], dim=-1)
         else:
             return normalized_pos
     
@@ -113,90 +124,97 @@ def build_edges_based_on_interactions(node_features, zscore_stats=None):
             else:
                 vx_mean, vx_std = zscore_stats['player_vx_mean'], zscore_stats['player_vx_std']
                 vy_mean, vy_std = zscore_stats['player_vy_mean'], zscore_stats['player_vy_std']
-            vx_real = normalized_vel[:, 0] * vx_std + vx_mean
-            vy_real = normalized_vel[:, 1] * vy_std + vy_mean
-            return torch.stack([vx_real, vy_real], dim=1)
+            vx_real = normalized_vel[..., 0] * vx_std + vx_mean
+            vy_real = normalized_vel[..., 1] * vy_std + vy_mean
+            return torch.stack([vx_real, vy_real], dim=-1)
         else:
             return normalized_vel
-        
-    def make_edges(s_t, d_t, rel):
-        s_idx = torch.where(masks[s_t])[0]          # (Ns,)
-        d_idx = torch.where(masks[d_t])[0]          # (Nd,)
-        if s_idx.numel() == 0 or d_idx.numel() == 0:
-            edge_index_dict[("Node", rel, "Node")] = torch.empty((2, 0), dtype=torch.long)
-            edge_attr_dict [("Node", rel, "Node")] = torch.empty((0, 1), dtype=torch.float32)
-            return
 
-        # 거리 계산 시 실제 거리 사용
-        s_pos_normalized = nodes[s_idx, :2]
-        d_pos_normalized = nodes[d_idx, :2]
+    # 거리 계산 시 실제 거리 사용
+    s_pos_normalized = nodes[..., s_idx, :2]
+    d_pos_normalized = nodes[..., d_idx, :2]
+    
+    s_pos = denormalize_positions(s_pos_normalized, s_t)
+    d_pos = denormalize_positions(d_pos_normalized, d_t)
+    dist = (s_pos.unsqueeze(-2) - d_pos.unsqueeze(-3)).norm(dim=-1)  # (..., Ns, Nd)
+    
+    # possession 플래그
+    poss_s = (poss_dur[..., s_idx].unsqueeze(-1) > 0.0)  # (..., Ns,1)
+    poss_d = (poss_dur[..., d_idx].unsqueeze(-2) > 0.0)  # (..., 1,Nd)
+    
+    if rel == "attk_and_attk" or rel == "def_and_def":
+        W_dist = 1.0 / (1.0 + dist)
         
-        s_pos = denormalize_positions(s_pos_normalized, s_t)
-        d_pos = denormalize_positions(d_pos_normalized, d_t)
-        dist = (s_pos.unsqueeze(1) - d_pos.unsqueeze(0)).norm(dim=-1)  # (Ns, Nd)
+        Nopp_s = (neighbor_count[..., s_idx] * 11).unsqueeze(-1)
+        Nopp_d = (neighbor_count[..., d_idx] * 11).unsqueeze(-2)
         
-        # possession 플래그
-        poss_s = (poss_dur[s_idx].unsqueeze(1) > 0.0)  # (Ns,1)
-        poss_d = (poss_dur[d_idx].unsqueeze(0) > 0.0)  # (1,Nd)
+        base_sit = torch.exp(-(Nopp_s + Nopp_d) / (dist + 1e-6))  # (Ns,Nd)
+        W_situation = base_sit * (poss_s | poss_d).float()
         
-        if rel == "attk_and_attk" or rel == "def_and_def":
-            W_dist = 1.0 / (1.0 + dist)
-            
-            Nopp_s = (neighbor_count[s_idx] * 11).unsqueeze(1)
-            Nopp_d = (neighbor_count[d_idx] * 11).unsqueeze(0)
-            
-            base_sit = torch.exp(-(Nopp_s + Nopp_d) / (dist + 1e-6))  # (Ns,Nd)
-            W_situation = base_sit * (poss_s | poss_d).float()
-            
-            weight = W_dist + W_situation
+        weight = W_dist + W_situation
 
-        elif rel == "attk_and_def":
-            W_dist = 1.0 / (1.0 + dist)
-            
-            dir_vec = (s_pos.unsqueeze(1) - d_pos.unsqueeze(0)) / (dist.unsqueeze(-1) + 1e-6)  # (Ns,Nd,2)
-            
-            v_normalized = nodes[d_idx, 2:4]
-            v_real = denormalize_velocities(v_normalized, d_t)
-            v_def = v_real.unsqueeze(0).expand(dist.size(0), -1, -1)                           # (Ns,Nd,2)
-            W_situation = (v_def * dir_vec).sum(dim=-1)
-            
-            weight = W_dist + W_situation
-
-        elif rel == "attk_and_ball" or rel == "def_and_ball":
-            W_dist = torch.exp(-dist * 0.15)
-            
-            dir_vec = (s_pos.unsqueeze(1) - d_pos.unsqueeze(0)) / (dist.unsqueeze(-1) + 1e-6)  # (Ns,Nd,2)
-            
-            v_s_normalized = nodes[s_idx, 2:4]
-            v_s = denormalize_velocities(v_s_normalized, s_t)  # (Ns,2)
-            v_s = v_s.unsqueeze(1)                # (Ns,1,2)
-            W_approach = (v_s * dir_vec).sum(dim=-1)
-            
-            if rel == "attk_and_ball":
-                t_pos = poss_dur[s_idx].unsqueeze(1)
-                sigma = (t_pos > 0).float()
-                # W_possess = torch.log1p(t_pos)
-                W_possess = t_pos  # Log-Normalized already
+    elif rel == "attk_and_def":
+        W_dist = 1.0 / (1.0 + dist)
         
-                W_situation = sigma * W_possess + (1 - sigma) * W_approach
-            else:
-                W_situation = W_approach
-                
-            weight = W_dist + W_situation
+        dir_vec = (s_pos.unsqueeze(-2) - d_pos.unsqueeze(-3)) / (dist.unsqueeze(-1) + 1e-6)  # (Ns,Nd,2)
+        
+        v_normalized = nodes[..., d_idx, 2:4]
+        v_real = denormalize_velocities(v_normalized, d_t)
+        v_def = v_real.unsqueeze(-3).expand_as(dir_vec)                                         # (Ns,Nd,2)
+        W_situation = (v_def * dir_vec).sum(dim=-1)
+        
+        weight = W_dist + W_situation
 
-        else: # Temporal edge
-            weight = torch.ones_like(dist)
+    elif rel == "attk_and_ball" or rel == "def_and_ball":
+        W_dist = torch.exp(-dist * 0.15)
         
-        # 음수 weight 방지
-        weight = torch.relu(weight) + 1e-6
-        # Threshold
-        dist_thr = 0.1
-        situation_thr = 0.05
+        dir_vec = (s_pos.unsqueeze(-2) - d_pos.unsqueeze(-3)) / (dist.unsqueeze(-1) + 1e-6)  # (Ns,Nd,2)
         
-        if rel != "temporal":
-            connection_mask = (W_dist > dist_thr) | (W_situation > situation_thr)
+        v_s_normalized = nodes[..., s_idx, 2:4]
+        v_s = denormalize_velocities(v_s_normalized, s_t)  # (Ns,2)
+        v_s = v_s.unsqueeze(-2)               # (Ns,1,2)
+        W_approach = (v_s * dir_vec).sum(dim=-1)
+        
+        if rel == "attk_and_ball":
+            t_pos = poss_dur[..., s_idx].unsqueeze(-1)
+            sigma = (t_pos > 0).float()
+            # W_possess = torch.log1p(t_pos)
+            W_possess = t_pos  # Log-Normalized already
+    
+            W_situation = sigma * W_possess + (1 - sigma) * W_approach
         else:
-            connection_mask = torch.ones_like(weight, dtype=torch.bool)
+            W_situation = W_approach
+            
+        weight = W_dist + W_situation
+
+    else: # Temporal edge
+        weight = torch.ones_like(dist)
+    
+    # 음수 weight 방지
+    weight = torch.relu(weight) + 1e-6
+    # Threshold
+    dist_thr = 0.1
+    situation_thr = 0.05
+    
+    if rel != "temporal":
+        connection_mask = (W_dist > dist_thr) | (W_situation > situation_thr)
+    else:
+        connection_mask = torch.ones_like(weight, dtype=torch.bool)
+
+    return s_idx, d_idx, weight, connection_mask
+
+
+# Edge
+def build_edges_based_on_interactions(node_features, zscore_stats=None):
+    edge_index_dict, edge_attr_dict = {}, {}
+    nodes = node_features["Node"]        # (N, F)
+        
+    def make_edges(s_t, d_t, rel):
+        s_idx, d_idx, weight, connection_mask = relation_weights(nodes, s_t, d_t, rel, zscore_stats)
+        if weight is None:
+            edge_index_dict[("Node", rel, "Node")] = torch.empty((2, 0), dtype=torch.long)
+            edge_attr_dict [("Node", rel, "Node")] = torch.empty((0, 1), dtype=torch.float32)
+            return
             
         # weight = torch.exp(-dist * 0.15) if d_t == 2 else 1.0 / (1.0 + dist)   # (Ns, Nd)
         
@@ -226,11 +244,8 @@ def build_edges_based_on_interactions(node_features, zscore_stats=None):
         edge_index_dict[("Node", rel, "Node")] = edge_index
         edge_attr_dict[("Node", rel, "Node")] = edge_attr
 
-    make_edges(0, 0, "attk_and_attk")
-    make_edges(0, 1, "attk_and_def")
-    make_edges(1, 1, "def_and_def")
-    make_edges(0, 2, "attk_and_ball")
-    make_edges(1, 2, "def_and_ball")
+    for s_t, d_t, rel in SPATIAL_RELATIONS:
+        make_edges(s_t, d_t, rel)
 
     return edge_index_dict, edge_attr_dict
 
@@ -305,3 +320,75 @@ def build_graph_sequence_from_condition(sample):
 
     return full_graph
 
+
+
+# Dense form of the same graph: every frame has 11 Attk + 11 Def + 1 Ball nodes, so each spatial relation
+# is a [T, 23, 23] matrix. adj[r, t, dst, src] counts the (dst <- src) edges of relation r (attk_and_attk /
+# def_and_def hold every edge twice, as the sparse graph does); temporal edges (t-1 -> t, same node) are implicit.
+# Collates field-wise with default_collate (x: [B, T, 23, F], adj / edge_weight: [B, R, T, 23, 23]).
+# edge_weight is only built on request (the encoder does not read it, as GATConv ignored the sparse edge_attr).
+class DenseGraph(NamedTuple):
+    x: torch.Tensor
+    adj: torch.Tensor
+    edge_weight: Optional[torch.Tensor] = None
+
+    def to(self, device, non_blocking=False):
+        return DenseGraph(*(t.to(device, non_blocking=non_blocking) if t is not None else None for t in self))
+
+
+# Vectorized extract_node_features over all frames: condition [T, F] -> [T, 23, 10]
+def extract_node_features_sequence(condition_tensor, condition_columns):
+    column_index_map = {col: idx for idx, col in enumerate(condition_columns)}
+
+    bases = []
+    for col in condition_columns:
+        if col.startswith("ball_"):
+            continue
+        parts = col.split("_", 2)
+        base = "_".join(parts[:2])
+        if base not in bases:
+            bases.append(base)
+
+    # column index per (node, feature), -1: missing -> default value
+    index, default = [], []
+    for node_type_idx, node_bases in ((0, bases[:11]), (1, bases[11:22]), (2, ["ball"])):
+        for base in node_bases:
+            feats = ["x", "y", "vx", "vy"]
+            if node_type_idx != 2:
+                feats += ["dist", "position", "starter", "possession_duration", "neighbor_count"]
+            cols = [column_index_map.get(f"{base}_{feat}", -1) for feat in feats]
+            index.append(cols + [-1] * (9 - len(cols)) + [-1])
+            default.append([0.0] * 4 + [-1.0] * 5 + [float(node_type_idx)])
+
+    index = torch.tensor(index, device=condition_tensor.device)
+    default = torch.tensor(default, device=condition_tensor.device, dtype=condition_tensor.dtype)
+    feats = condition_tensor[:, index.clamp(min=0)]      # [T, 23, 10]
+    return torch.where(index >= 0, feats, default)
+
+
+def build_dense_graph_from_condition(sample, with_edge_weight=False):
+    condition = sample["condition"]     # [T, F]
+    zscore_stats = sample.get("zscore_stats", None)
+
+    nodes = extract_node_features_sequence(condition, sample["condition_columns"])
+    T, N, _ = nodes.shape
+
+    adj = torch.zeros((len(SPATIAL_RELATIONS), T, N, N), dtype=torch.uint8, device=nodes.device)
+    edge_weight = None
+    if with_edge_weight:
+        edge_weight = torch.zeros((len(SPATIAL_RELATIONS), T, N, N), dtype=torch.float32, device=nodes.device)
+    for r, (s_t, d_t, rel) in enumerate(SPATIAL_RELATIONS):
+        s_idx, d_idx, weight, connection_mask = relation_weights(nodes, s_t, d_t, rel, zscore_stats)
+        if weight is None:
+            continue
+        block = torch.zeros((T, N, N), dtype=torch.uint8, device=nodes.device)           # [T, src, dst]
+        block[:, s_idx.unsqueeze(1), d_idx.unsqueeze(0)] = connection_mask.to(torch.uint8)
+
+        # forward (src -> dst) + reverse edges; weights are > 0 on edges and symmetric within a relation
+        adj[r] = block.transpose(1, 2) + block
+        if with_edge_weight:
+            block_weight = torch.zeros((T, N, N), dtype=torch.float32, device=nodes.device)
+            block_weight[:, s_idx.unsqueeze(1), d_idx.unsqueeze(0)] = weight.float() * connection_mask
+            edge_weight[r] = torch.maximum(block_weight.transpose(1, 2), block_weight)
+
+    return DenseGraph(nodes, adj, edge_weight)
@@ -0,0 +1,99 @@
+import math
+
+from utils.utils import calc_frechet_distance_batch
+
+# Batched trajectory metrics for best-of-N evaluation.
+# Shapes: predictions [S, B, T, N, 2], targets [B, T, N, 2] (any leading dims broadcast), in meters.
+
+
+# z-score -> meters for absolute player positions, x: [..., 2]
+def denorm_players(x, zscore_stats):
+    mean = x.new_tensor([zscore_stats['player_x_mean'], zscore_stats['player_y_mean']])
+    std = x.new_tensor([zscore_stats['player_x_std'], zscore_stats['player_y_std']])
+    return x * std + mean
+
+
+# Normalized relative predictions [..., T, N, 2] + reference positions in meters [B, N, 2] -> absolute meters
+def rel_to_absolute(pred_rel, ref_denorm, zscore_stats):
+    mean = pred_rel.new_tensor([zscore_stats['rel_x_mean'], zscore_stats['rel_y_mean']])
+    std = pred_rel.new_tensor([zscore_stats['rel_x_std'], zscore_stats['rel_y_std']])
+    return pred_rel * std + mean + ref_denorm.unsqueeze(-3)
+
+
+# ADE / FDE / Fréchet / DE(Direction Error) per sample -> dict of [...] (e.g. [S, B])
+def trajectory_metrics(pred, target, eps=1e-6):
+    pred, target = pred[..., :2], target[..., :2]
+
+    dist = (pred - target).norm(dim=-1)  # [..., T, N]
+    ade = dist.mean((-2, -1))
+    fde = dist[..., -1, :].mean(-1)
+
+    overall_pred = pred[..., -1, :, :] - pred[..., 0, :, :]
+    overall_gt = target[..., -1, :, :] - target[..., 0, :, :]
+    u = overall_pred / overall_pred.norm(dim=-1, keepdim=True).clamp(min=eps)
+    v = overall_gt / overall_gt.norm(dim=-1, keepdim=True).clamp(min=eps)
+    de = (u * v).sum(-1).clamp(-1.0, 1.0).acos().mean(-1)
+
+    frechet = calc_frechet_distance_batch(pred.transpose(-3, -2), target.transpose(-3, -2)).mean(-1)
+
+    return {'ade': ade, 'fde': fde, 'frechet': frechet, 'de': de}
+
+
+# Min over the sample dim for every metric; 'best_idx' is the sample with the lowest ADE
+def best_of_n(metrics, dim=0):
+    best = {k: v.min(dim=dim).values for k, v in metrics.items()}
+    best['best_idx'] = metrics['ade'].argmin(dim=dim)
+    return best
+
+
+# Same outputs as the single-sample loop: pred/target [B, T, N, 2] -> (ade, fde, frechet, DE), each [B]
+def calc_trajectory_metrics(pred_absolute, target_absolute, eps=1e-6):
+    m = trajectory_metrics(pred_absolute, target_absolute, eps=eps)
+    return m['ade'], m['fde'], m['frechet'], m['de']
+
+
+# Streaming mean / std (population, like np.std) kept on device; merges batches with Chan's update
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        x = x.detach().reshape(-1).double()
+        n = x.numel()
+        if n == 0:
+            return
+        batch_mean = x.mean()
+        batch_m2 = ((x - batch_mean) ** 2).sum()
+        if self.mean is None:
+            self.count, self.mean, self.m2 = n, batch_mean, batch_m2
+            return
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + batch_m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    def result(self):
+        if self.mean is None:
+            return float('nan'), float('nan')
+        return self.mean.item(), (self.m2 / self.count).sqrt().item()
+
+
+# Feed raw trajectory_metrics outputs (DE in radians); every script reports DE in degrees from here
+class MetricAggregator:
+    def __init__(self, names=('ade', 'fde', 'frechet', 'de'), degrees=('de',)):
+        self.stats = {name: RunningStats() for name in names}
+        self.degrees = set(degrees)
+
+    def update(self, metrics):
+        for name, stat in self.stats.items():
+            stat.update(metrics[name])
+
+    # {name: (mean, std)}, the only host sync
+    def summary(self):
+        summary = {name: stat.result() for name, stat in self.stats.items()}
+        for name in self.degrees & summary.keys():
+            summary[name] = tuple(math.degrees(v) for v in summary[name])
+        return summary
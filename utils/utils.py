@@ -1,6 +1,10 @@
 import os
 import random
+import time
+import contextlib
+from collections import defaultdict
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 from tslearn.metrics import SoftDTWLossPyTorch
 from torch_geometric.data import HeteroData
@@ -34,6 +38,76 @@ def generator(seed=42):
     g.manual_seed(seed)
     return g
 
+# Mixed precision context: amp_dtype None (fp32) / 'bf16' / 'fp16'
+def get_autocast(device, amp_dtype=None):
+    if amp_dtype is None:
+        return contextlib.nullcontext()
+    dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[amp_dtype]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+# Distributed (DDP) setup from the torchrun environment (RANK / WORLD_SIZE / LOCAL_RANK), e.g.
+# `torchrun --nproc_per_node=4 main_for_Diffoot.py`. Without it: a single process on `device`.
+# CUDA: one GPU per process (cuda:LOCAL_RANK) with nccl, CPU: gloo. Returns (rank, world_size, device).
+def init_distributed(device, backend=None):
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1, device
+    rank = int(os.environ["RANK"])
+    if torch.device(device).type == 'cuda':
+        device = f"cuda:{int(os.environ['LOCAL_RANK'])}"
+        torch.cuda.set_device(device)
+    dist.init_process_group(backend or ('nccl' if torch.device(device).type == 'cuda' else 'gloo'),
+                            rank=rank, world_size=world_size)
+    return rank, world_size, device
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+# Per-phase wall time of training steps: mark(phase) charges the time since the previous mark to `phase`.
+# Synchronizes the device at every mark, so only for profiling (enabled=False: no-op).
+class StepTimer:
+    def __init__(self, device, enabled=True):
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+        self.steps = 0
+        self.last = None
+
+    def start(self):
+        if self.enabled:
+            self.last = self._now()
+
+    def _now(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = self._now()
+        self.totals[phase] += now - self.last
+        self.last = now
+
+    def step(self):
+        self.steps += 1
+
+    # "phase 12.3ms | ..." per step
+    def summary(self):
+        steps = max(self.steps, 1)
+        return " | ".join(f"{phase} {total / steps * 1000:.1f}ms" for phase, total in self.totals.items())
+
 
 # Load team sheet information from matchinformation XML files
 def load_team_sheets(path):
@@ -348,6 +422,38 @@ def calc_frechet_distance(P, Q):
         return D[i, j]
     return c(T-1, T-1)
 
+# Discrete Fréchet distance, iterative DP over anti-diagonals for a whole batch at once.
+# P: [..., Tp, 2], Q: [..., Tq, 2] (torch or numpy) -> [...]
+def calc_frechet_distance_batch(P, Q):
+    is_numpy = isinstance(P, np.ndarray)
+    if is_numpy:
+        P, Q = torch.from_numpy(P), torch.from_numpy(Q)
+    Tp, Tq = P.size(-2), Q.size(-2)
+    P, Q = torch.broadcast_tensors(P[..., :, None, :], Q[..., None, :, :])
+    P, Q = P[..., :, 0, :], Q[..., 0, :, :]
+
+    ii = torch.arange(Tp, device=P.device)
+    inf_col = P.new_full(P.shape[:-2] + (1,), float('inf'))
+
+    # D[i, k - i] on the current / previous two anti-diagonals, indexed by i
+    prev2 = P.new_full(P.shape[:-1], float('inf'))
+    prev1 = prev2.clone()
+    prev1[..., 0] = (P[..., 0, :] - Q[..., 0, :]).norm(dim=-1)
+
+    for k in range(1, Tp + Tq - 1):
+        jj = k - ii
+        valid = (jj >= 0) & (jj < Tq)
+        d = (P - Q[..., jj.clamp(0, Tq - 1), :]).norm(dim=-1)
+
+        up = torch.cat([inf_col, prev1[..., :-1]], dim=-1)  # D[i-1, j]
+        diag = torch.cat([inf_col, prev2[..., :-1]], dim=-1)  # D[i-1, j-1]
+        cur = torch.maximum(torch.minimum(torch.minimum(up, prev1), diag), d)
+        cur = torch.where(valid, cur, torch.full_like(cur, float('inf')))
+        prev2, prev1 = prev1, cur
+
+    out = prev1[..., Tp - 1]
+    return out.numpy() if is_numpy else out
+
 
 def per_player_fde_loss(pred, target):
     diff = pred[:, -1] - target[:, -1]     # [B, N, 2]
@@ -446,7 +552,9 @@ def plot_pitch( field_dimen = (106.0,68.0), field_color ='green', linewidth=2, m
 
 
 ## Vizualization
-def plot_trajectories_on_pitch(others, target, pred, other_columns = None, defenders_num=None, annotate=False, save_path=None):
+# figax: pre-drawn (fig, ax) pitch to reuse; artists added here are removed again after saving
+def plot_trajectories_on_pitch(others, target, pred, other_columns = None, defenders_num=None, annotate=False, save_path=None,
+                               figax=None, bbox_inches='tight'):
     if torch.is_tensor(others):
         others = others.cpu().numpy()
     if torch.is_tensor(target):
@@ -454,7 +562,11 @@ def plot_trajectories_on_pitch(others, target, pred, other_columns = None, defen
     if torch.is_tensor(pred):
         pred = pred.cpu().numpy()
     
-    fig, ax = plot_pitch(field_dimen=(105.0, 68.0), field_color='green')
+    if figax is None:
+        fig, ax = plot_pitch(field_dimen=(105.0, 68.0), field_color='green')
+    else:
+        fig, ax = figax
+        base_artists = set(ax.get_children())
 
     # 1) attackers
     for m in range(11):
@@ -516,8 +628,13 @@ def plot_trajectories_on_pitch(others, target, pred, other_columns = None, defen
     # ax.legend(loc='lower center', bbox_to_anchor=(0.5, -0.03), ncol=4, frameon=True)
 
     if save_path:
-        fig.savefig(save_path, bbox_inches='tight')
-        plt.close(fig)
+        fig.savefig(save_path, bbox_inches=bbox_inches)
+        if figax is None:
+            plt.close(fig)
+        else:
+            for artist in ax.get_children():
+                if artist not in base_artists:
+                    artist.remove()
     else:
         plt.show()
 